@@ -1,92 +1,272 @@
-from numba import cuda
+from numba import cuda, njit, prange
 import numpy as np
-import math
-from scipy.ndimage import uniform_filter
+from scipy.ndimage import uniform_filter, maximum_filter
 import userInput as u
+import narrowBand as nb
+from backend import useCuda
+import csg
+from quantize import isQuantized
 try: TPB = u.TPB 
 except: TPB = 8
+try: SMOOTH_BAND = u.SMOOTH_BAND
+except: SMOOTH_BAND = True
 
-try:
-    CUDA_AVAILABLE = cuda.is_available()
-except Exception:
-    CUDA_AVAILABLE = False
 
-def _smooth_cpu(u, iteration=1, buffer=0):
+def _smooth_cpu(u, iteration=1, buffer=0, out=None):
+    #Ping-pongs between out and one scratch grid, ordered so the last pass lands in out.
+    src = np.asarray(u, dtype=np.float32)
+    if out is None:
+        out = np.empty(src.shape, dtype=np.float32)
+    elif np.may_share_memory(src, out):
+        src = src.copy()
     if iteration <= 0:
-        return u.copy()
-    result = u.astype(np.float32, copy=True)
+        out[...] = src
+        return out
     buffer = max(buffer, 0)
+    keep = buffer > 0 and all(dim > 2*buffer for dim in src.shape)
+    scratch = np.empty(src.shape, dtype=np.float32) if iteration > 1 else None
+    for step in range(iteration):
+        dst = out if (iteration - step) % 2 == 1 else scratch
+        uniform_filter(src, size=3, mode="nearest", output=dst)
+        if keep:
+            for axis in range(3):
+                for edge in (slice(0, buffer), slice(src.shape[axis] - buffer, None)):
+                    index = [slice(None)]*3
+                    index[axis] = edge
+                    dst[tuple(index)] = src[tuple(index)]
+        src = dst
+    return out
+
+# Band-limited smoothing. The 3x3x3 mean is three 1D 3-tap means, and the
+# per-axis filters commute, so `iteration` passes equal `iteration` 3-tap passes
+# along Z, then Y, then X; each line does all of its passes in one go, in place.
+# Only bricks whose (2*iteration+1)-neighbourhood holds both signs are touched.
+# Every voxel on an edge that crosses zero after smoothing is computed exactly,
+# and every other voxel keeps its sign, so marching cubes sees the same surface
+# as a full smooth while far-field values stay as they were.
+
+def smoothReach(iteration):
+    #Voxels of context smooth() needs on each side (halo for slab-wise callers).
+    return 2*iteration + 1 if SMOOTH_BAND else iteration
+
+@njit(parallel=True)
+def _brick_signs(u, brick, le, ge):
+    #le/ge = per brick, whether any voxel is <= 0 / >= 0
+    m, n, p = u.shape
+    for bi in prange(le.shape[0]):
+        for i in range(bi*brick, min((bi+1)*brick, m)):
+            for j in range(n):
+                for kb in range(le.shape[2]):
+                    lo = u[i,j,kb*brick]
+                    hi = lo
+                    for k in range(kb*brick+1, min((kb+1)*brick, p)):
+                        lo = min(lo, u[i,j,k])
+                        hi = max(hi, u[i,j,k])
+                    if lo <= 0:
+                        le[bi, j//brick, kb] = True
+                    if hi >= 0:
+                        ge[bi, j//brick, kb] = True
+
+def _smooth_bricks(u, iteration, brick=nb.BRICK):
+    #Bricks to smooth: both signs occur within 2*iteration+1 voxels of the brick.
+    shape = tuple(-(-dim // brick) for dim in u.shape)
+    le = np.zeros(shape, dtype=np.uint8)
+    ge = np.zeros(shape, dtype=np.uint8)
+    _brick_signs(u, brick, le.view(np.bool_), ge.view(np.bool_))
+    size = 2*(-(-(2*iteration + 1) // brick)) + 1
+    le = maximum_filter(le, size=size, mode="constant")
+    ge = maximum_filter(ge, size=size, mode="constant")
+    return np.logical_and(le, ge)
+
+@njit
+def _smooth_segment(line, lo, hi, iteration, buf):
+    #iteration 3-tap means over line[lo:hi]; neighbours outside the segment stay
+    #fixed and the grid ends repeat (mode "nearest"). Sums are kept in float64.
+    p = line.shape[0]
+    a = max(lo - 1, 0)
+    b = min(hi + 1, p)
+    for q in range(a, b):
+        buf[q - a] = line[q]
+    last = b - a - 1
     for _ in range(iteration):
-        smoothed = uniform_filter(result, size=3, mode="nearest")
-        if buffer > 0 and all(dim > 2*buffer for dim in result.shape):
-            inner = tuple(slice(buffer, dim - buffer) for dim in result.shape)
-            updated = result.copy()
-            updated[inner] = smoothed[inner]
-            result = updated
-        else:
-            result = smoothed
-    return result.astype(np.float32)
-
-def _union_cpu(u,v):
-    return np.minimum(u, v).astype(np.float32)
-
-def _intersection_cpu(u,v):
-    return np.maximum(u, v).astype(np.float32)
-
-def _subtract_cpu(u,v):
-    return np.maximum(-u, v).astype(np.float32)
-
-def _projection_cpu(u):
-    result = u.astype(np.float32, copy=True)
-    m = result.shape[0]
-    min_x = -1
-    for i in range(m):
-        if np.amin(result[i,:,:]) < 0:
-            min_x = i
-            break
-    if min_x < 0:
-        return result
-    for X in range(m-2, min_x-1, -1):
-        mask = result[X+1,:,:] <= 0
-        if np.any(mask):
-            layer = result[X,:,:]
-            layer[mask] = -1
-            result[X,:,:] = layer
-    return result
-
-def _translate_cpu(u,x,y,z):
-    return np.roll(u, shift=(x,y,z), axis=(0,1,2)).astype(np.float32)
+        prev = buf[max(lo - a - 1, 0)]
+        for q in range(lo - a, hi - a):
+            cur = buf[q]
+            nxt = buf[min(q + 1, last)]
+            buf[q] = (prev + cur + nxt)/3.0
+            prev = cur
+    for q in range(lo, hi):
+        line[q] = buf[q - a]
+
+@njit(parallel=True)
+def _smooth_band_pass(u, bricks, brick, iteration):
+    #Smooths along the last axis, segment by segment over runs of active bricks.
+    m, n, p = u.shape
+    nk = bricks.shape[2]
+    for i in prange(m):
+        buf = np.empty(p, dtype=np.float64)
+        for j in range(n):
+            kb = 0
+            while kb < nk:
+                if not bricks[i//brick, j//brick, kb]:
+                    kb += 1
+                    continue
+                start = kb
+                while kb < nk and bricks[i//brick, j//brick, kb]:
+                    kb += 1
+                _smooth_segment(u[i, j], start*brick, min(kb*brick, p), iteration, buf)
+
+def _smooth_band_cpu(u, iteration, out):
+    if out is None:
+        out = np.array(u, dtype=np.float32)
+    elif out is not u:
+        out[...] = u
+    if iteration <= 0:
+        return out
+    bricks = _smooth_bricks(out, iteration)
+    for axes in ((0, 1, 2), (0, 2, 1), (1, 2, 0)):
+        _smooth_band_pass(out.transpose(axes), bricks.transpose(axes), nb.BRICK, iteration)
+    return out
+
+@njit(parallel=True)
+def _projection_cpu(out, minX):
+    #Column scan down X: threads split Y, the inner loop runs along contiguous Z rows.
+    m, n, p = out.shape
+    for j in prange(n):
+        for X in range(m-2, minX-1, -1):
+            for k in range(p):
+                if out[X+1,j,k] <= 0:
+                    out[X,j,k] = -1
+
+def _translate_cpu(u,x,y,z,out):
+    #np.roll without its temporary: the up to eight wrapped blocks are copied straight into out.
+    pieces = []
+    for shift, dim in zip((x,y,z), u.shape):
+        shift %= dim
+        pieces.append(((slice(0, dim-shift), slice(shift, dim)), (slice(dim-shift, dim), slice(0, shift))))
+    for a in pieces[0]:
+        for b in pieces[1]:
+            for c in pieces[2]:
+                out[a[1], b[1], c[1]] = u[a[0], b[0], c[0]]
+    return out
+
+@njit
+def _combine_rows(dst, a, b, takeMax):
+    if takeMax:
+        for k in range(dst.shape[0]):
+            dst[k] = max(a[k], b[k])
+    else:
+        for k in range(dst.shape[0]):
+            dst[k] = min(a[k], b[k])
+
+@njit
+def _combine_row(u, src, out, i, j, si, sj, dz, takeMax, inPlace):
+    #out[i,j,k] = min/max(u[i,j,k], src[si,sj,k-dz]) along one Z row, keeping
+    #u where the source is outside the grid.
+    p = u.shape[2]
+    lo, hi = max(dz, 0), min(p + dz, p)
+    if not (0 <= si < src.shape[0] and 0 <= sj < src.shape[1]) or lo >= hi:
+        if not inPlace:
+            out[i,j,:] = u[i,j,:]
+        return
+    if not inPlace:
+        out[i,j,:lo] = u[i,j,:lo]
+        out[i,j,hi:] = u[i,j,hi:]
+    _combine_rows(out[i,j,lo:hi], u[i,j,lo:hi], src[si,sj,lo-dz:hi-dz], takeMax)
+
+@njit(parallel=True)
+def _combine_shifted_cpu(u, out, dx, dy, dz, takeMax, inPlace):
+    #Rows are visited against the shift so that, in place, a source row is read
+    #before it is overwritten; threads split an axis without shift. A pure Z
+    #shift reads its own row, so each thread combines from a copy of its layer.
+    m, n, p = u.shape
+    if dx == 0 and dy == 0:
+        for i in prange(m):
+            layer = u[i:i+1].copy() if inPlace else u[i:i+1]
+            for j in range(n):
+                _combine_row(u, layer, out, i, j, 0, j, dz, takeMax, inPlace)
+    elif dx == 0:
+        for i in prange(m):
+            for jj in range(n):
+                j = n - 1 - jj if dy > 0 else jj
+                _combine_row(u, u, out, i, j, i, j - dy, dz, takeMax, inPlace)
+    elif dy == 0:
+        for j in prange(n):
+            for ii in range(m):
+                i = m - 1 - ii if dx > 0 else ii
+                _combine_row(u, u, out, i, j, i - dx, j, dz, takeMax, inPlace)
+    else:
+        for ii in range(m):
+            i = m - 1 - ii if dx > 0 else ii
+            for jj in range(n):
+                j = n - 1 - jj if dy > 0 else jj
+                _combine_row(u, u, out, i, j, i - dx, j - dy, dz, takeMax, inPlace)
 
 def _condense_cpu(u,buffer):
-    arr = u.astype(np.float32, copy=True)
+    arr = np.asarray(u, dtype=np.float32)
     mask = arr < 0
     if not np.any(mask):
-        return arr
+        return arr.copy()
     coords = np.argwhere(mask)
     mins = coords.min(axis=0)
     maxs = coords.max(axis=0)
-    starts = []
-    stops = []
-    pads = []
+    del mask, coords
+    src = []
+    dst = []
+    size = []
+    padded = False
     dims = arr.shape
     for axis in range(3):
         start = mins[axis] - buffer
         stop = maxs[axis] + buffer + 1
-        pad_before = max(0, -start)
-        pad_after = max(0, stop - dims[axis])
-        start = max(start, 0)
-        stop = min(stop, dims[axis])
-        starts.append(start)
-        stops.append(stop)
-        pads.append((pad_before, pad_after))
-    slices = tuple(slice(starts[i], stops[i]) for i in range(3))
-    condensed = arr[slices].copy()
-    if any(pad[0] > 0 or pad[1] > 0 for pad in pads):
-        background = float(np.max(arr))
-        if background <= 0:
-            background = 0.01
-        condensed = np.pad(condensed, pads, mode="constant", constant_values=background)
-    return condensed.astype(np.float32)
+        size.append(stop - start)
+        padded = padded or start < 0 or stop > dims[axis]
+        src.append(slice(max(start, 0), min(stop, dims[axis])))
+        dst.append(slice(max(start, 0) - start, min(stop, dims[axis]) - start))
+    if not padded:
+        return arr[tuple(src)].copy()
+    background = float(np.max(arr))
+    if background <= 0:
+        background = 0.01
+    condensed = np.full(size, background, dtype=np.float32)
+    condensed[tuple(dst)] = arr[tuple(src)]
+    return condensed
+
+@cuda.jit
+def smoothAxisKernel(d_u, d_v, d_bricks, brick, axis):
+    #One separable pass: mean of the in-bounds neighbours along axis, the same
+    #normalisation as smoothKernel. Voxels outside the active bricks are copied.
+    i,j,k = cuda.grid(3)
+    m,n,p = d_u.shape
+    if i >= m or j >= n or k >= p:
+        return
+    if not d_bricks[i//brick, j//brick, k//brick]:
+        d_v[i,j,k] = d_u[i,j,k]
+        return
+    total = d_u[i,j,k]
+    count = 1
+    if axis == 0:
+        if i > 0:
+            total += d_u[i-1,j,k]
+            count += 1
+        if i < m-1:
+            total += d_u[i+1,j,k]
+            count += 1
+    elif axis == 1:
+        if j > 0:
+            total += d_u[i,j-1,k]
+            count += 1
+        if j < n-1:
+            total += d_u[i,j+1,k]
+            count += 1
+    else:
+        if k > 0:
+            total += d_u[i,j,k-1]
+            count += 1
+        if k < p-1:
+            total += d_u[i,j,k+1]
+            count += 1
+    d_v[i,j,k] = total/count
 
 @cuda.jit
 def smoothKernel(d_u, d_v, buffer):
@@ -104,117 +284,99 @@ def smoothKernel(d_u, d_v, buffer):
                 count+=1
         d_v[i,j,k] = d_v[i,j,k]/count
 
-def smooth(u,iteration = 1,buffer=0):
+def smooth(u,iteration = 1,buffer=0,out=None):
     #u = input voxel model
     #iteration = number of times to run the algorithm
     #buffer = Layers of voxels on the boundaries of the box that are left untouched
+    #out = optional float32 array for the result, may be u itself
     #Outputs a new matrix with each value set to the average of its neighbor's values.
-    if not CUDA_AVAILABLE:
-        return _smooth_cpu(u, iteration, buffer)
+    #With SMOOTH_BAND and no buffer only the band around the surface is smoothed
+    #(same marching-cubes surface); far-field values keep their original value.
+    #A QuantizedField is smoothed in float32 and stored back with its step.
+    if nb.isBand(u):
+        return nb.mapSlabs(u, lambda slab: smooth(slab, iteration, buffer), smoothReach(iteration) + buffer)
+    if isQuantized(u):
+        return csg.quantize(smooth(u.toDense(), iteration, buffer), u.step, out)
+    band = SMOOTH_BAND and buffer <= 0
+    if not useCuda("smooth", u.size):
+        if band:
+            return _smooth_band_cpu(u, iteration, out)
+        return _smooth_cpu(u, iteration, buffer, out)
     TPBX, TPBY, TPBZ = TPB, TPB, TPB
     dims = u.shape
     d_u = cuda.to_device(u)
     d_v = cuda.to_device(u)
     gridDims = (dims[0]+TPBX-1)//TPBX, (dims[1]+TPBY-1)//TPBY, (dims[2]+TPBZ-1)//TPBZ
     blockDims = TPBX, TPBY, TPBZ
-    for var in range(iteration):
-        smoothKernel[gridDims, blockDims](d_u, d_v,buffer)
-        d_u,d_v = d_v,d_u
-    return d_u.copy_to_host()
+    if band:
+        d_bricks = cuda.to_device(_smooth_bricks(np.asarray(u, dtype=np.float32), iteration))
+        for var in range(iteration):
+            for axis in range(3):
+                smoothAxisKernel[gridDims, blockDims](d_u, d_v, d_bricks, nb.BRICK, axis)
+                d_u,d_v = d_v,d_u
+    else:
+        for var in range(iteration):
+            smoothKernel[gridDims, blockDims](d_u, d_v,buffer)
+            d_u,d_v = d_v,d_u
+    if out is None:
+        return d_u.copy_to_host()
+    d_u.copy_to_host(out)
+    return out
 
-@cuda.jit
-def boolKernel(d_u,d_v):
-    i,j,k = cuda.grid(3)
-    dims = d_u.shape
-    if i >= dims[0] or j >= dims[1] or k >= dims[2]:
-        return
-    d_u[i,j,k] = min(d_u[i,j,k],d_v[i,j,k])
-    
-def union(u,v):
+def union(u,v,out=None):
     #u,v = voxel models that you want to union
+    #out = optional float32 array for the result, may be u or v (pass it to work in place)
     #Outputs the union of the models (fills in the resulting matrix such that 
     #if a cell is negative in either u or v, it is negative in the output).
-    if not CUDA_AVAILABLE:
-        return _union_cpu(u, v)
-    d_u = cuda.to_device(u)
-    d_v = cuda.to_device(v)
-    dims = u.shape
-    gridSize = (
-        (dims[0] + TPB - 1) // TPB,
-        (dims[1] + TPB - 1) // TPB,
-        (dims[2] + TPB - 1) // TPB,
-    )
-    blockSize = (TPB, TPB, TPB)
-    boolKernel[gridSize, blockSize](d_u,d_v)
-    return d_u.copy_to_host()
+    #Eager form of csg.union; build csg expressions to fuse several operations.
+    return csg.union(u, v).evaluate(out)
 
-def intersection(u,v):
+def intersection(u,v,out=None):
     #u,v = voxel models that you want to intersect
     #Outputs the intersection of the models (fills in the resulting matrix such
     #that if a cell is positive in either u or v, it is positive in the output).
-    if not CUDA_AVAILABLE:
-        return _intersection_cpu(u, v)
-    d_u = cuda.to_device(-1*u)
-    d_v = cuda.to_device(-1*v)
-    dims = u.shape
-    gridSize = (
-        (dims[0] + TPB - 1) // TPB,
-        (dims[1] + TPB - 1) // TPB,
-        (dims[2] + TPB - 1) // TPB,
-    )
-    blockSize = (TPB, TPB, TPB)
-    boolKernel[gridSize, blockSize](d_u,d_v)
-    return -1*d_u.copy_to_host()
+    return csg.intersection(u, v).evaluate(out)
 
-def subtract(u,v):
+def subtract(u,v,out=None):
     #u = cutting tool model (Model that's removed)
     #v = base model
     #Outputs the subtraction of the models (fills in the resulting matrix such
     #that if a cell is negative in u, it's positive in the output)
-    if not CUDA_AVAILABLE:
-        return _subtract_cpu(u, v)
-    d_u = cuda.to_device(u)
-    d_v = cuda.to_device(-1*v)
-    dims = u.shape
-    gridSize = (
-        (dims[0] + TPB - 1) // TPB,
-        (dims[1] + TPB - 1) // TPB,
-        (dims[2] + TPB - 1) // TPB,
-    )
-    blockSize = (TPB, TPB, TPB)
-    boolKernel[gridSize, blockSize](d_u,d_v)
-    return -1*d_u.copy_to_host()
+    return csg.subtract(u, v).evaluate(out)
 
 @cuda.jit
-def projectionKernel(d_u,X):
+def projectionKernel(d_u,minX):
     j,k = cuda.grid(2)
     m,n,p = d_u.shape
     if j < n and k < p:
-        if d_u[X+1,j,k]<=0:
-            d_u[X,j,k]=-1    
+        for X in range(m-2,minX-1,-1):
+            if d_u[X+1,j,k]<=0:
+                d_u[X,j,k]=-1
 
-def projection(u):
+def projection(u,out=None):
     #u = voxelized model, negative = internal
+    #out = optional float32 array for the result, may be u itself
     #Assumes X is the vertical axis, projects entire part to lowest X value.
-    if not CUDA_AVAILABLE:
-        return _projection_cpu(u)
+    #Every (Y,Z) column is scanned once from the top down to the lowest solid layer.
+    layers = np.flatnonzero((np.asarray(u) < 0).any(axis=(1,2)))
+    if out is None:
+        out = np.array(u, dtype=np.float32)
+    elif out is not u:
+        out[...] = u
+    if layers.size == 0:
+        return out
+    minX = int(layers[0])
+    if not useCuda("projection", u.size):
+        _projection_cpu(out, minX)
+        return out
     TPBY, TPBZ = TPB, TPB
     m, n, p = u.shape
-    minX = -1
-    i = 0
-    while minX<0:
-        if np.amin(u[i,:,:])<0:
-            minX = i
-        else:
-            i += 1
-    X = m-1
-    d_u = cuda.to_device(u)
+    d_u = cuda.to_device(np.asarray(u, dtype=np.float32))
     gridDims = (n+TPBY-1)//TPBY, (p+TPBZ-1)//TPBZ
     blockDims = TPBY, TPBZ
-    while X>minX:
-        X -= 1
-        projectionKernel[gridDims, blockDims](d_u,X)
-    return d_u.copy_to_host()
+    projectionKernel[gridDims, blockDims](d_u,minX)
+    d_u.copy_to_host(out)
+    return out
 
 @cuda.jit
 def translateKernel(d_u,d_v,x,y,z):
@@ -224,12 +386,15 @@ def translateKernel(d_u,d_v,x,y,z):
         return
     d_v[i,j,k] = d_u[(i-x)%m,(j-y)%n,(k-z)%p]
     
-def translate(u,x,y,z):
+def translate(u,x,y,z,out=None):
     #u = voxel model to translate
     #x,y,z = translation vector, integers in voxels
+    #out = optional float32 array for the result, must not overlap u
     #moves the model according to the translation vector.
-    if not CUDA_AVAILABLE:
-        return _translate_cpu(u, x, y, z)
+    if out is None:
+        out = np.empty(u.shape, dtype=np.float32)
+    if not useCuda("translate", u.size):
+        return _translate_cpu(u, x, y, z, out)
     d_u = cuda.to_device(u)
     d_v = cuda.device_array(shape = u.shape, dtype = np.float32)
     dims = u.shape
@@ -240,18 +405,78 @@ def translate(u,x,y,z):
     )
     blockSize = (TPB, TPB, TPB)
     translateKernel[gridSize, blockSize](d_u,d_v,x,y,z)
-    return d_v.copy_to_host()
+    d_v.copy_to_host(out)
+    return out
+
+@cuda.jit
+def combineShiftedKernel(d_u,d_v,x,y,z,takeMax):
+    i,j,k = cuda.grid(3)
+    m,n,p = d_u.shape
+    if i >= m or j >= n or k >= p:
+        return
+    value = d_u[i,j,k]
+    if 0 <= i-x < m and 0 <= j-y < n and 0 <= k-z < p:
+        if takeMax:
+            value = max(value, d_u[i-x,j-y,k-z])
+        else:
+            value = min(value, d_u[i-x,j-y,k-z])
+    d_v[i,j,k] = value
 
-def thicken(u,weight):
+def combineShifted(u,x,y,z,op="union",out=None):
+    #u = voxel model
+    #x,y,z = shift of the second operand, integers in voxels (as in translate)
+    #op = "union" (min) or "intersection" (max)
+    #out = optional float32 array for the result, may be u itself
+    #Outputs op(u, translate(u,x,y,z)) in one pass and without a shifted copy.
+    #Unlike translate nothing wraps around: where the shifted voxel would come
+    #from outside the grid, u is kept.
+    takeMax = op == "intersection"
+    if out is None:
+        out = np.empty(u.shape, dtype=np.float32)
+    if not useCuda("combineShifted", u.size):
+        _combine_shifted_cpu(u, out, x, y, z, takeMax, out is u)
+        return out
+    d_u = cuda.to_device(u)
+    d_v = cuda.device_array(shape = u.shape, dtype = np.float32)
+    dims = u.shape
+    gridSize = (
+        (dims[0] + TPB - 1) // TPB,
+        (dims[1] + TPB - 1) // TPB,
+        (dims[2] + TPB - 1) // TPB,
+    )
+    blockSize = (TPB, TPB, TPB)
+    combineShiftedKernel[gridSize, blockSize](d_u,d_v,x,y,z,takeMax)
+    d_v.copy_to_host(out)
+    return out
+
+def dilate(u,shifts,out=None):
+    #u = voxel model
+    #shifts = (x,y,z) voxel offsets, applied one after the other
+    #out = optional float32 array for the result, may be u itself
+    #Grows the solid along each offset: union of the model with itself moved by
+    #the first shift, then the result with itself moved by the next, and so on.
+    for x, y, z in shifts:
+        u = out = combineShifted(u, x, y, z, "union", out)
+    return u
+
+def erode(u,shifts,out=None):
+    #Same as dilate with intersections: a voxel stays solid only if the voxel
+    #it would receive from each shift is solid too.
+    for x, y, z in shifts:
+        u = out = combineShifted(u, x, y, z, "intersection", out)
+    return u
+
+def thicken(u,weight,out=None):
     #u = voxel model to thicken, assumes SDF
     #origShape = outer bounds of model
     #weight = how much we're thickening the object (In voxels)
-    return u - np.ones(u.shape)*weight
+    #out = optional float32 array for the result, may be u itself
+    return csg.thicken(u, weight).evaluate(out)
     
-def shell(uSDF,sT):
+def shell(uSDF,sT,out=None):
     #u = voxel model to shell, assumes SDF
     #sT = thickness of the shell (In voxels)
-    return intersection(uSDF,-uSDF-np.ones(uSDF.shape)*sT)
+    return csg.shell(uSDF, sT).evaluate(out)
 
 @cuda.jit
 def condenseKernel(d_u,d_uCondensed,buffer,minX,minY,minZ):
@@ -265,7 +490,7 @@ def condense(u,buffer):
     #buffer = number of layers of voxels around the boundaries that are left empty
     #Outputs a new matrix that is fitted to the input voxel model, removing layers
     #that don't store geometry.
-    if not CUDA_AVAILABLE:
+    if not useCuda("condense", u.size):
         return _condense_cpu(u, buffer)
     m, n, p = u.shape
     TPBX, TPBY, TPBZ = TPB, TPB, TPB
@@ -300,131 +525,36 @@ def condense(u,buffer):
     condenseKernel[gridDims, blockDims](d_u, d_uCondensed,buffer,minX,minY,minZ)
     return d_uCondensed.copy_to_host()
 
-@cuda.jit
-def heartKernel(d_u, d_x, d_y, d_z,cx,cy,cz):
-    i,j,k = cuda.grid(3)
-    m,n,p = d_u.shape
-    if i < m and j < n and k < p:
-        x = d_x[i]-cx
-        y = d_y[j]-cy
-        z = d_z[k]-cz
-        d_u[i,j,k] = (x**2+9*(y**2)/4+z**2-1)**3-(x**2)*(z**3)-9*(y**2)*(z**3)/80
-        
+# Analytic primitives: eager forms of the csg primitive leaves, computed from the
+# axis vectors on either backend. Build csg expressions to combine several.
 def heart(x,y,z,cx,cy,cz):
     #x,y,z = coordinate domain that we want the shape to live in, vectors
     #cx,cy,cz = coordinates of the center of the heart shape.
     #Outputs a 3D matrix with negative values showing the inside of our shape, 
     #positive values showing the outside, and 0s to show the surfaces.
-    if not CUDA_AVAILABLE:
-        X, Y, Z = np.meshgrid(x - cx, y - cy, z - cz, indexing="ij")
-        return (X**2 + 9*(Y**2)/4 + Z**2 - 1)**3 - (X**2)*(Z**3) - 9*(Y**2)*(Z**3)/80
-    TPBX, TPBY, TPBZ = TPB, TPB, TPB
-    m = x.shape[0]
-    n = y.shape[0]
-    p = z.shape[0]
-    d_x = cuda.to_device(x)
-    d_y = cuda.to_device(y)
-    d_z = cuda.to_device(z)
-    d_u = cuda.device_array(shape = [m, n, p], dtype = np.float32)
-    gridDims = (m+TPBX-1)//TPBX, (n+TPBY-1)//TPBY, (n+TPBZ-1)//TPBZ
-    blockDims = TPBX, TPBY, TPBZ
-    heartKernel[gridDims, blockDims](d_u, d_x, d_y, d_z,cx,cy,cz)
-    return d_u.copy_to_host()
+    return csg.heart(x,y,z,cx,cy,cz).evaluate()
 
-@cuda.jit
-def eggKernel(d_u, d_x, d_y, d_z,cx,cy,cz):
-    i,j,k = cuda.grid(3)
-    m,n,p = d_u.shape
-    if i < m and j < n and k < p:
-        x = d_x[i]-cx
-        y = d_y[j]-cy
-        z = d_z[k]-cz
-        d_u[i,j,k] = 9*x**2+16*(y**2+z**2)+2*x*(y**2+z**2)+(y**2+z**2)-144
-        
 def egg(x,y,z,cx,cy,cz):
     #x,y,z = coordinate domain that we want the shape to live in, vectors
     #cx,cy,cz = coordinates of the center of the egg shape.
     #Outputs a 3D matrix with negative values showing the inside of our shape, 
     #positive values showing the outside, and 0s to show the surfaces.
-    if not CUDA_AVAILABLE:
-        X, Y, Z = np.meshgrid(x - cx, y - cy, z - cz, indexing="ij")
-        return 9*X**2 + 16*(Y**2 + Z**2) + 2*X*(Y**2 + Z**2) + (Y**2 + Z**2) - 144
-    TPBX, TPBY, TPBZ = TPB, TPB, TPB
-    m = x.shape[0]
-    n = y.shape[0]
-    p = z.shape[0]
-    d_x = cuda.to_device(x)
-    d_y = cuda.to_device(y)
-    d_z = cuda.to_device(z)
-    d_u = cuda.device_array(shape = [m, n, p], dtype = np.float32)
-    gridDims = (m+TPBX-1)//TPBX, (n+TPBY-1)//TPBY, (n+TPBZ-1)//TPBZ
-    blockDims = TPBX, TPBY, TPBZ
-    eggKernel[gridDims, blockDims](d_u, d_x, d_y, d_z,cx,cy,cz)
-    return d_u.copy_to_host()
+    return csg.egg(x,y,z,cx,cy,cz).evaluate()
 
-@cuda.jit
-def rectKernel(d_u, d_x, d_y, d_z, xl, yl, zl, origin):
-    i,j,k = cuda.grid(3)
-    m,n,p = d_u.shape
-    if i < m and j < n and k < p:
-        sx = abs(d_x[i]-origin[0]) - xl/2
-        sy = abs(d_y[j]-origin[1]) - yl/2
-        sz = abs(d_z[k]-origin[2]) - zl/2
-        d_u[i,j,k]=max(sx,sy,sz)
-        
 def rect(x,y,z,xl,yl,zl,origin = [0,0,0]):
     #x,y,z = coordinate domain that we want the shape to live in, vectors
     #xl,yl,zl = sidelengths of the rectangular prism.
     #origin = coordinates for the center of the prism
     #Outputs a 3D matrix with negative values showing the inside of our shape, 
     #positive values showing the outside, and 0s to show the surfaces.
-    TPBX, TPBY, TPBZ = TPB, TPB, TPB
-    m = x.shape[0]
-    n = y.shape[0]
-    p = z.shape[0]
-    d_x = cuda.to_device(x)
-    d_y = cuda.to_device(y)
-    d_z = cuda.to_device(z)
-    d_origin = cuda.to_device(origin)
-    d_u = cuda.device_array(shape = [m, n, p], dtype = np.float32)
-    gridDims = (m+TPBX-1)//TPBX, (n+TPBY-1)//TPBY, (n+TPBZ-1)//TPBZ
-    blockDims = TPBX, TPBY, TPBZ
-    rectKernel[gridDims, blockDims](d_u, d_x, d_y, d_z, xl, yl, zl, d_origin)
-    return d_u.copy_to_host()
+    return csg.rect(x,y,z,xl,yl,zl,origin).evaluate()
 
-@cuda.jit
-def sphereKernel(d_u, d_x, d_y, d_z, rad):
-    i,j,k = cuda.grid(3)
-    m,n,p = d_u.shape
-    if i < m and j < n and k < p:
-        d_u[i,j, k] = math.sqrt(d_x[i]**2+d_y[j]**2+d_z[k]**2)-rad
-        
 def sphere(x,y,z,rad):
     #x,y,z = x,y,z coordinate domain that we want the shape to live in.
     #rad = radius of the sphere.
     #Outputs a 3D matrix with negative values showing the inside of our shape, 
     #positive values showing the outside, and 0s to show the surfaces.
-    TPBX, TPBY, TPBZ = TPB, TPB, TPB
-    m = x.shape[0]
-    n = y.shape[0]
-    p = z.shape[0]
-    d_x = cuda.to_device(x)
-    d_y = cuda.to_device(y)
-    d_z = cuda.to_device(z)
-    d_u = cuda.device_array(shape = [m, n, p], dtype = np.float32)
-    gridDims = (m+TPBX-1)//TPBX, (n+TPBY-1)//TPBY, (n+TPBZ-1)//TPBZ
-    blockDims = TPBX, TPBY, TPBZ
-    sphereKernel[gridDims, blockDims](d_u, d_x, d_y, d_z, rad)
-    return d_u.copy_to_host()
-
-@cuda.jit
-def cylinderXKernel(d_u, d_x, d_y, d_z, start, stop, rad):
-    i,j,k = cuda.grid(3)
-    m,n,p = d_u.shape
-    if i < m and j < n and k < p:
-        height = (d_x[i]-start)*(d_x[i]-stop)
-        width = math.sqrt(d_y[j]**2+d_z[k]**2)-rad
-        d_u[i,j,k] = max(height,width)
+    return csg.sphere(x,y,z,rad).evaluate()
 
 def cylinderX(x,y,z,start,stop,rad):
     #x,y,z = x,y,z coordinate domain that we want the shape to live in.
@@ -432,27 +562,7 @@ def cylinderX(x,y,z,start,stop,rad):
     #rad = radius of the cylinder.
     #Outputs a 3D matrix with negative values showing the inside of our shape, 
     #positive values showing the outside, and 0s to show the surfaces.
-    TPBX, TPBY, TPBZ = TPB, TPB, TPB
-    m = x.shape[0]
-    n = y.shape[0]
-    p = z.shape[0]
-    d_x = cuda.to_device(x)
-    d_y = cuda.to_device(y)
-    d_z = cuda.to_device(z)
-    d_u = cuda.device_array(shape = [m, n, p], dtype = np.float32)
-    gridDims = (m+TPBX-1)//TPBX, (n+TPBY-1)//TPBY, (n+TPBZ-1)//TPBZ
-    blockDims = TPBX, TPBY, TPBZ
-    cylinderXKernel[gridDims, blockDims](d_u, d_x, d_y, d_z, start, stop, rad)
-    return d_u.copy_to_host()
-
-@cuda.jit
-def cylinderYKernel(d_u, d_x, d_y, d_z, start, stop, rad):
-    i,j,k = cuda.grid(3)
-    m,n,p = d_u.shape
-    if i < m and j < n and k < p:
-        height = (d_y[j]-start)*(d_y[j]-stop)
-        width = math.sqrt(d_x[i]**2+d_z[k]**2)-rad
-        d_u[i,j,k] = max(height,width)
+    return csg.cylinderX(x,y,z,start,stop,rad).evaluate()
 
 def cylinderY(x,y,z,start,stop,rad):
     #x,y,z = x,y,z coordinate domain that we want the shape to live in.
@@ -460,15 +570,4 @@ def cylinderY(x,y,z,start,stop,rad):
     #rad = radius of the cylinder.
     #Outputs a 3D matrix with negative values showing the inside of our shape, 
     #positive values showing the outside, and 0s to show the surfaces.
-    TPBX, TPBY, TPBZ = TPB, TPB, TPB
-    m = x.shape[0]
-    n = y.shape[0]
-    p = z.shape[0]
-    d_x = cuda.to_device(x)
-    d_y = cuda.to_device(y)
-    d_z = cuda.to_device(z)
-    d_u = cuda.device_array(shape = [m, n, p], dtype = np.float32)
-    gridDims = (m+TPBX-1)//TPBX, (n+TPBY-1)//TPBY, (n+TPBZ-1)//TPBZ
-    blockDims = TPBX, TPBY, TPBZ
-    cylinderYKernel[gridDims, blockDims](d_u, d_x, d_y, d_z, start, stop, rad)
-    return d_u.copy_to_host()
+    return csg.cylinderY(x,y,z,start,stop,rad).evaluate()
@@ -1,16 +1,26 @@
-from numba import cuda
+from numba import cuda, njit, prange
 import math
 import numpy as np
 from scipy import ndimage
+from scipy.spatial import cKDTree
 import userInput as u
+import narrowBand as nb
+from backend import useCuda
+from quantize import isQuantized
+from csg import quantize
 try: TPB = u.TPB 
 except: TPB = 8
-try:
-    CUDA_AVAILABLE = cuda.is_available()
-except Exception:
-    CUDA_AVAILABLE = False
+JF_CPU_ENGINE = getattr(u, "JF_CPU_ENGINE", "auto")
+KD_ACTIVE_FRACTION = 0.1 #Below this active fraction, querying a cKDTree per active voxel beats a full EDT (~6x cheaper per voxel)
 
 def _jump_flood_cpu(u, norm):
+    #"auto" keeps the exact EDT for Euclidean seeds (faster on CPU, see
+    #benchmark.py) and uses the compiled jump flood for every other order.
+    if JF_CPU_ENGINE == "jfa" or (JF_CPU_ENGINE == "auto" and norm != 2.0):
+        return _jump_flood_numba(u, norm)
+    return _jump_flood_edt(u)
+
+def _jump_flood_edt(u):
     arr = np.asarray(u, dtype=np.float32)
     mask = arr > 0
     distances, indices = ndimage.distance_transform_edt(
@@ -22,7 +32,278 @@ def _jump_flood_cpu(u, norm):
     result[..., 3] = distances.astype(np.float32)
     return result
 
+@njit(parallel=True)
+def _jf_setup_cpu(u, pr):
+    m, n, p = u.shape
+    for i in prange(m):
+        for j in range(n):
+            for k in range(p):
+                if u[i,j,k] <= 0.0:
+                    pr[i,j,k,0] = i
+                    pr[i,j,k,1] = j
+                    pr[i,j,k,2] = k
+                    pr[i,j,k,3] = 0.0
+
+@njit(parallel=True)
+def _jf_pass_cpu(pr, pw, stepSize, order):
+    #One jump flood pass, same neighbourhood and update rule as JFKernelNorm.
+    m, n, p = pr.shape[0], pr.shape[1], pr.shape[2]
+    for i in prange(m):
+        for j in range(n):
+            for k in range(p):
+                sm, sn, sp, d = pr[i,j,k,0], pr[i,j,k,1], pr[i,j,k,2], pr[i,j,k,3]
+                for index in range(27):
+                    ci = i+((index//9)%3-1)*stepSize
+                    cj = j+((index//3)%3-1)*stepSize
+                    ck = k+(index%3-1)*stepSize
+                    if ci < 0 or cj < 0 or ck < 0 or ci >= m or cj >= n or ck >= p:
+                        continue
+                    m1, n1, p1 = pr[ci,cj,ck,0], pr[ci,cj,ck,1], pr[ci,cj,ck,2]
+                    if order == 2.0:
+                        d1 = math.sqrt((i-m1)*(i-m1)+(j-n1)*(j-n1)+(k-p1)*(k-p1))
+                    elif order == 1.0:
+                        d1 = abs(i-m1)+abs(j-n1)+abs(k-p1)
+                    else:
+                        d1 = (abs(i-m1)**order+abs(j-n1)**order+abs(k-p1)**order)**(1.0/order)
+                    if d1 < d:
+                        sm, sn, sp, d = m1, n1, p1, d1
+                pw[i,j,k,0] = sm
+                pw[i,j,k,1] = sn
+                pw[i,j,k,2] = sp
+                pw[i,j,k,3] = d
+
+def _jump_flood_numba(u, norm):
+    #Multithreaded CPU version of the CUDA jump flood, any Lp order.
+    dims = u.shape
+    pr = np.full(dims + (4,), 1000, dtype=np.float32)
+    pw = np.full(dims + (4,), 1000, dtype=np.float32)
+    _jf_setup_cpu(np.asarray(u, dtype=np.float32), pr)
+    n = int(round(np.log2(max(dims)-1)+0.5))
+    steps = [2**(n-count-1) for count in range(n)] + [2, 1]
+    for stepSize in steps:
+        _jf_pass_cpu(pr, pw, stepSize, float(norm))
+        pr, pw = pw, pr
+    return pr
+
+@njit
+def _lp_distance(i, j, k, seed, order):
+    di, dj, dk = abs(i-seed[0]), abs(j-seed[1]), abs(k-seed[2])
+    if order == 2.0:
+        return math.sqrt(di*di+dj*dj+dk*dk)
+    if order == 1.0:
+        return float(di+dj+dk)
+    return (di**order+dj**order+dk**order)**(1.0/order)
+
+@njit(parallel=True)
+def _jf_label_pass_cpu(lr, lw, seeds, stepSize, order):
+    #Jump flood pass on seed labels; distances come from the seed table.
+    m, n, p = lr.shape
+    for i in prange(m):
+        for j in range(n):
+            for k in range(p):
+                best = lr[i,j,k]
+                d = _lp_distance(i, j, k, seeds[best], order) if best >= 0 else np.inf
+                for index in range(27):
+                    ci = i+((index//9)%3-1)*stepSize
+                    cj = j+((index//3)%3-1)*stepSize
+                    ck = k+(index%3-1)*stepSize
+                    if ci < 0 or cj < 0 or ck < 0 or ci >= m or cj >= n or ck >= p:
+                        continue
+                    label = lr[ci,cj,ck]
+                    if label < 0 or label == best:
+                        continue
+                    d1 = _lp_distance(i, j, k, seeds[label], order)
+                    if d1 < d:
+                        best, d = label, d1
+                lw[i,j,k] = best
+
+@njit(parallel=True)
+def _seed_distance_cpu(labels, seeds, order, out):
+    m, n, p = labels.shape
+    for i in prange(m):
+        for j in range(n):
+            for k in range(p):
+                label = labels[i,j,k]
+                out[i,j,k] = _lp_distance(i, j, k, seeds[label], order) if label >= 0 else 1000.0
+
+def _jump_flood_labels_edt(u, seeds):
+    #Exact nearest seed from the separable EDT below, carrying each seed's label
+    #through the passes: one float32 and one int32 grid, no feature-index arrays.
+    dist = np.full(u.shape, EDT_INF, dtype=np.float32)
+    labels = np.full(u.shape, -1, dtype=np.int32)
+    dist[seeds[:,0], seeds[:,1], seeds[:,2]] = 0
+    labels[seeds[:,0], seeds[:,1], seeds[:,2]] = np.arange(len(seeds), dtype=np.int32)
+    # X, then Y, then Z: the same pass order as scipy's feature transform, so ties
+    # go to the same seed.
+    for axes in ((1, 2, 0), (0, 2, 1), (0, 1, 2)):
+        _edt_label_pass(dist.transpose(axes), labels.transpose(axes))
+    return labels
+
+EDT_INF = 1e30 #Squared distance standing in for "no feature on this row yet"
+
+@njit
+def _edt_row(f, d, v, z):
+    #1D squared distance transform of f into d (Felzenszwalb & Huttenlocher, lower envelope of parabolas).
+    n = f.shape[0]
+    k = -1
+    for q in range(n):
+        if f[q] >= EDT_INF:
+            continue
+        if k < 0:
+            k = 0
+            v[0] = q
+            z[0] = -np.inf
+            z[1] = np.inf
+            continue
+        fq = f[q] + q*q
+        s = (fq - (f[v[k]] + v[k]*v[k]))/(2.0*(q - v[k]))
+        while s <= z[k]:
+            k -= 1
+            s = (fq - (f[v[k]] + v[k]*v[k]))/(2.0*(q - v[k]))
+        k += 1
+        v[k] = q
+        z[k] = s
+        z[k+1] = np.inf
+    if k < 0:
+        d[:] = EDT_INF
+        return
+    k = 0
+    for q in range(n):
+        while z[k+1] < q:
+            k += 1
+        r = v[k]
+        d[q] = (q - r)*(q - r) + f[r]
+
+@njit(parallel=True)
+def _edt_pass(outside, inside):
+    #Transforms the last axis of both fields in place, threads split the first axis.
+    m, n, p = outside.shape
+    for i in prange(m):
+        f = np.empty(p, dtype=np.float32)
+        d = np.empty(p, dtype=np.float32)
+        v = np.empty(p, dtype=np.int64)
+        z = np.empty(p+1, dtype=np.float64)
+        for j in range(n):
+            f[:] = outside[i, j, :]
+            _edt_row(f, d, v, z)
+            outside[i, j, :] = d
+            f[:] = inside[i, j, :]
+            _edt_row(f, d, v, z)
+            inside[i, j, :] = d
+
+@njit
+def _edt_label_row(f, lab, d, dl, v, z):
+    #_edt_row that also reports, in dl, the label of the parabola each voxel lands on.
+    n = f.shape[0]
+    k = -1
+    for q in range(n):
+        if f[q] >= EDT_INF:
+            continue
+        if k < 0:
+            k = 0
+            v[0] = q
+            z[0] = -np.inf
+            z[1] = np.inf
+            continue
+        fq = f[q] + q*q
+        s = (fq - (f[v[k]] + v[k]*v[k]))/(2.0*(q - v[k]))
+        while s <= z[k]:
+            k -= 1
+            s = (fq - (f[v[k]] + v[k]*v[k]))/(2.0*(q - v[k]))
+        k += 1
+        v[k] = q
+        z[k] = s
+        z[k+1] = np.inf
+    if k < 0:
+        d[:] = EDT_INF
+        dl[:] = -1
+        return
+    k = 0
+    for q in range(n):
+        while z[k+1] < q:
+            k += 1
+        r = v[k]
+        d[q] = (q - r)*(q - r) + f[r]
+        dl[q] = lab[r]
+
+@njit(parallel=True)
+def _edt_label_pass(dist, labels):
+    m, n, p = dist.shape
+    for i in prange(m):
+        f = np.empty(p, dtype=np.float32)
+        d = np.empty(p, dtype=np.float32)
+        lab = np.empty(p, dtype=np.int32)
+        dl = np.empty(p, dtype=np.int32)
+        v = np.empty(p, dtype=np.int64)
+        z = np.empty(p+1, dtype=np.float64)
+        for j in range(n):
+            f[:] = dist[i, j, :]
+            lab[:] = labels[i, j, :]
+            _edt_label_row(f, lab, d, dl, v, z)
+            dist[i, j, :] = d
+            labels[i, j, :] = dl
+
+@njit(parallel=True)
+def _edt_setup(u, outside, inside):
+    m, n, p = u.shape
+    for i in prange(m):
+        for j in range(n):
+            for k in range(p):
+                if u[i,j,k] <= 0:
+                    outside[i,j,k] = 0.0
+                    inside[i,j,k] = EDT_INF
+                else:
+                    outside[i,j,k] = EDT_INF
+                    inside[i,j,k] = 0.0
+
+@njit(parallel=True)
+def _edt_finish(outside, inside):
+    m, n, p = outside.shape
+    for i in prange(m):
+        for j in range(n):
+            for k in range(p):
+                if outside[i,j,k] > 0:
+                    outside[i,j,k] = math.sqrt(outside[i,j,k])
+                else:
+                    outside[i,j,k] = -math.sqrt(inside[i,j,k])
+
+def _jump_flood_labels_kd(seeds, active, norm, batch=1 << 20):
+    #Exact nearest seed (in the given Lp norm) for the active voxels only, -1 elsewhere.
+    labels = np.full(active.shape, -1, dtype=np.int32)
+    tree = cKDTree(seeds)
+    coords = np.argwhere(active)
+    for start in range(0, len(coords), batch):
+        chunk = coords[start:start+batch]
+        _, idx = tree.query(chunk, k=1, p=norm, workers=-1)
+        labels[chunk[:,0], chunk[:,1], chunk[:,2]] = idx
+    return labels
+
 def _sdf3d_cpu(u, norm):
+    #Exact Euclidean SDF: separable squared transforms of the outside and inside
+    #feature sets, both carried through each axis pass, in float32 throughout.
+    #Other Lp orders take the jump flood pair the CUDA path uses.
+    arr = np.asarray(u, dtype=np.float32)
+    if norm != 2.0:
+        return _sdf3d_lp_cpu(arr, norm)
+    inner = arr <= 0
+    if not inner.any() or inner.all():
+        return _sdf3d_scipy(arr, norm) #No surface; keep scipy's conventions for the degenerate case
+    del inner
+    outside = np.empty(arr.shape, dtype=np.float32)
+    inside = np.empty(arr.shape, dtype=np.float32)
+    _edt_setup(arr, outside, inside)
+    for axes in ((0, 1, 2), (0, 2, 1), (1, 2, 0)):
+        _edt_pass(outside.transpose(axes), inside.transpose(axes))
+    _edt_finish(outside, inside)
+    return outside
+
+def _sdf3d_lp_cpu(u, norm):
+    #CPU version of jumpFlood(u) and jumpFlood(-u) merged by toSDF.
+    dp = _jump_flood_numba(u, norm)[..., 3]
+    dn = _jump_flood_numba(-u, norm)[..., 3]
+    return np.where(dp > 0, dp, -dn).astype(np.float32)
+
+def _sdf3d_scipy(u, norm):
     arr = np.asarray(u, dtype=np.float32)
     inside = arr <= 0
     outside = ~inside
@@ -45,20 +326,15 @@ def _simplify_cpu(u):
     result[surface] = 0.0
     return result
 
-def _xheight_cpu(u):
-    arr = _simplify_cpu(u)
-    result = arr.copy()
-    m = result.shape[0]
-    for i in range(m-2, -1, -1):
-        below = result[i+1,:,:]
-        mask = below <= 0
-        if not np.any(mask):
-            continue
-        update = np.minimum(-1, below - 1)
-        layer = result[i,:,:]
-        layer[mask] = update[mask]
-        result[i,:,:] = layer
-    return result
+@njit(parallel=True)
+def _xheight_cpu(out):
+    #Column scan down X, same update as xHeightKernel.
+    m, n, p = out.shape
+    for j in prange(n):
+        for i in range(m-2, -1, -1):
+            for k in range(p):
+                if out[i,j,k] <= 0:
+                    out[i,j,k] = min(-1.0, out[i+1,j,k]-1)
 
 @cuda.jit(device = True)
 def norm(i,j,k,m,n,p,order):
@@ -119,7 +395,7 @@ def jumpFlood(u,norm):
     #inside the object, positive is outside, and 0 is on the surface.
     #Output formatted as follows: 
     #u[i,j,k,d]=(i coord of Nearest Seed (NS), j coord of NS, k coord of NS, distance to NS)
-    if not CUDA_AVAILABLE:
+    if not useCuda("jumpFlood", u.size):
         return _jump_flood_cpu(u, norm)
     dims = u.shape
     gridSize = (
@@ -153,6 +429,83 @@ def jumpFlood(u,norm):
             d_r,d_w = d_w,d_r
     return d_r.copy_to_host()
 
+@cuda.jit(device = True)
+def labelDistance(i,j,k,d_seeds,label,order):
+    di = abs(i-d_seeds[label,0])
+    dj = abs(j-d_seeds[label,1])
+    dk = abs(k-d_seeds[label,2])
+    if order==2.0:
+        return math.sqrt(di*di+dj*dj+dk*dk)
+    return (di**order+dj**order+dk**order)**(1/order)
+
+@cuda.jit
+def JFLabelKernel(d_lr,d_lw,d_seeds,stepSize,order):
+    i,j,k = cuda.grid(3)
+    dims = d_lr.shape
+    if i>=dims[0] or j>=dims[1] or k>=dims[2]:
+        return
+    best = d_lr[i,j,k]
+    d = 1e30
+    if best>=0:
+        d = labelDistance(i,j,k,d_seeds,best,order)
+    for index in range(27):
+        ci = i+((index//9)%3-1)*stepSize
+        cj = j+((index//3)%3-1)*stepSize
+        ck = k+(index%3-1)*stepSize
+        if ci<dims[0] and cj<dims[1] and ck<dims[2] and ci>=0 and cj>=0 and ck>=0:
+            label = d_lr[ci,cj,ck]
+            if label>=0 and label!=best:
+                d1 = labelDistance(i,j,k,d_seeds,label,order)
+                if d1<d:
+                    best,d = label,d1
+    d_lw[i,j,k] = best
+
+def jumpFloodLabels(u,norm,active=None):
+    #u = same input as jumpFlood
+    #active = optional boolean mask of the voxels that need labels. Only the KD
+    #engine uses it (the rest stay -1); the flood engines label every voxel,
+    #since jump flood needs inactive voxels to relay seeds between active regions.
+    #Outputs (labels, seeds): an int32 grid holding the index of the nearest seed
+    #for every voxel, and the (S,3) int32 table of seed coordinates. A quarter
+    #of the memory of the jumpFlood output; use seedDistance for the distances.
+    seeds = np.argwhere(np.asarray(u) <= 0).astype(np.int32)
+    sparse = active is not None and active.mean() < KD_ACTIVE_FRACTION
+    cpu = not useCuda("jumpFloodLabels", u.size)
+    if cpu and sparse and len(seeds) and JF_CPU_ENGINE != "jfa":
+        return _jump_flood_labels_kd(seeds, active, norm), seeds
+    if cpu and JF_CPU_ENGINE != "jfa" and (JF_CPU_ENGINE == "edt" or norm == 2.0):
+        return _jump_flood_labels_edt(u, seeds), seeds
+    dims = u.shape
+    labels = np.full(dims, -1, dtype=np.int32)
+    labels[seeds[:,0], seeds[:,1], seeds[:,2]] = np.arange(len(seeds), dtype=np.int32)
+    n = int(round(np.log2(max(dims)-1)+0.5))
+    steps = [2**(n-count-1) for count in range(n)] + [2, 1]
+    if cpu:
+        other = np.empty_like(labels)
+        for stepSize in steps:
+            _jf_label_pass_cpu(labels, other, seeds, stepSize, float(norm))
+            labels, other = other, labels
+        return labels, seeds
+    gridSize = (
+        (dims[0] + TPB - 1) // TPB,
+        (dims[1] + TPB - 1) // TPB,
+        (dims[2] + TPB - 1) // TPB,
+    )
+    blockSize = (TPB, TPB, TPB)
+    d_r = cuda.to_device(labels)
+    d_w = cuda.device_array(dims, dtype=np.int32)
+    d_seeds = cuda.to_device(seeds.astype(np.float32))
+    for stepSize in steps:
+        JFLabelKernel[gridSize, blockSize](d_r,d_w,d_seeds,stepSize,float(norm))
+        d_r,d_w = d_w,d_r
+    return d_r.copy_to_host(), seeds
+
+def seedDistance(labels,seeds,norm=2.0):
+    #Distance from every voxel to its labelled seed, the [...,3] channel of jumpFlood.
+    out = np.empty(labels.shape, dtype=np.float32)
+    _seed_distance_cpu(labels, seeds, float(norm), out)
+    return out
+
 @cuda.jit
 def toSDF(JFpos,JFneg,d_u):
     i,j,k = cuda.grid(3)
@@ -166,12 +519,28 @@ def toSDF(JFpos,JFneg,d_u):
     else:
         d_u[i,j,k]=-dn
 
+def _band_slab(slab, norm, band):
+    #SDF3D of one slab of a band field. A slab without a surface is entirely
+    #farther than band from it, so it is filled with the clamped value.
+    inside = slab <= 0
+    if inside.all() or not inside.any():
+        return np.full(slab.shape, -band if inside.flat[0] else band, dtype=np.float32)
+    return SDF3D(slab, norm)
+
 def SDF3D(u,norm=2.0):
     #u = a voxel model where the negative values indicate that the voxel is 
     #inside the object, positive is outside, and 0 is on the surface.
     #Outputs a new voxel model where the same sign rules apply, but the value 
     #of the cell indicates how far away that cell is from the nearest surface.
-    if not CUDA_AVAILABLE:
+    #A NarrowBandField input gives a NarrowBandField output with the same band,
+    #a QuantizedField input a QuantizedField with the same step.
+    if nb.isBand(u):
+        #Distances inside the band only depend on surface voxels within band of
+        #them, so dense X slabs with a band-wide halo keep every stored value exact.
+        return nb.mapSlabs(u, lambda slab: _band_slab(slab, norm, u.band), int(np.ceil(u.band)) + 1)
+    if isQuantized(u):
+        return quantize(SDF3D(u.toDense(), norm), u.step)
+    if not useCuda("SDF3D", u.size):
         return _sdf3d_cpu(u, norm)
     dims = u.shape
     gridSize = (
@@ -209,7 +578,7 @@ def simplifyKernel(d_u,d_v):
         d_v[i,j,k]=.01
 
 def simplify(u):
-    if not CUDA_AVAILABLE:
+    if not useCuda("simplify", u.size):
         return _simplify_cpu(u)
     d_u = cuda.to_device(u)
     dims = u.shape
@@ -224,24 +593,26 @@ def simplify(u):
     return d_v.copy_to_host()
 
 @cuda.jit
-def xHeightKernel(d_u,i):
+def xHeightKernel(d_u):
     j,k = cuda.grid(2)
     m,n,p = d_u.shape
-    if j < n and k < p and d_u[i,j,k]<=0:
-            d_u[i,j,k]=min(-1,d_u[i+1,j,k]-1)
+    if j < n and k < p:
+        for i in range(m-2,-1,-1):
+            if d_u[i,j,k]<=0:
+                d_u[i,j,k]=min(-1,d_u[i+1,j,k]-1)
 
 def xHeight(u):
     #u = voxelized model, negative = internal
     #Assumes X is the vertical axis, sets each solid voxel value to the above value minus 1.
-    if not CUDA_AVAILABLE:
-        return _xheight_cpu(u)
+    #Empty voxels keep their value; each (Y,Z) column is scanned once.
+    if not useCuda("xHeight", u.size):
+        out = _simplify_cpu(u)
+        _xheight_cpu(out)
+        return out
     m, n, p = u.shape
     TPBY, TPBZ = TPB, TPB
-    gridDims = (n+TPBY-1)//TPBY, (n+TPBZ-1)//TPBZ
+    gridDims = (n+TPBY-1)//TPBY, (p+TPBZ-1)//TPBZ
     blockDims = TPBY, TPBZ
-    i = m-2
     d_u = cuda.to_device(simplify(u))
-    while i>0:
-        xHeightKernel[gridDims, blockDims](d_u,i)
-        i -= 1
+    xHeightKernel[gridDims, blockDims](d_u)
     return d_u.copy_to_host()
@@ -1,12 +1,11 @@
 from numba import cuda
 import numpy as np
 import userInput as u
+import narrowBand as nb
+from backend import useCuda
+from quantize import isQuantized
 try: TPB = u.TPB 
 except: TPB = 8
-try:
-    CUDA_AVAILABLE = cuda.is_available()
-except Exception:
-    CUDA_AVAILABLE = False
 
 @cuda.reduce
 def sum_reduce(a, b):
@@ -18,7 +17,12 @@ def findVol(u,scale,MAT_DENSITY,name):
     #MAT_DENSITY = density (g/mm^3) of the print material
     #name = name of the input model
     cellVol = scale[0]*scale[1]*scale[2]
-    if CUDA_AVAILABLE:
+    if nb.isBand(u) or isQuantized(u):
+        count = u.countInside()
+    elif isinstance(u, np.memmap):
+        step = max((1 << 24)//max(u.shape[1]*u.shape[2], 1), 1)
+        count = sum(int(np.count_nonzero(u[i:i+step] <= 0)) for i in range(0, u.shape[0], step))
+    elif useCuda("findVol", u.size):
         d_u = cuda.to_device(u)
         dims = u.shape
         gridSize = (
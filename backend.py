@@ -0,0 +1,83 @@
+from numba import cuda
+from contextlib import contextmanager
+import json
+import os
+import userInput as u
+
+# Chooses the CPU or CUDA path of each operation. Every kernel wrapper copies
+# its grid to the device and back, so small grids are faster on the CPU; the
+# crossover (in voxels) is read per operation from a calibration table written
+# by `python benchmark.py --calibrate`. BACKEND forces one side everywhere and
+# BACKEND_OVERRIDES forces it for single operations, e.g. {"smooth": "cpu"}.
+# The CPU side is the host path each module already has (numba prange kernels,
+# or numpy/scipy where those won the benchmarks).
+
+try:
+    CUDA_AVAILABLE = cuda.is_available()
+except Exception:
+    CUDA_AVAILABLE = False
+try: BACKEND = u.BACKEND
+except: BACKEND = "auto"
+try: BACKEND_OVERRIDES = dict(u.BACKEND_OVERRIDES)
+except: BACKEND_OVERRIDES = {}
+
+TABLE_PATH = os.path.join(os.path.dirname(__file__), 'Cache', 'backend.json')
+DEFAULT_CROSSOVER = 1 << 18 #Voxels (64^3) below which the CPU wins when there is no table
+
+_table = None
+_forced = None
+
+def _device():
+    try:
+        name = cuda.get_current_device().name
+    except Exception:
+        return ""
+    return name.decode() if isinstance(name, bytes) else str(name)
+
+def loadTable(path=TABLE_PATH):
+    #Outputs {op: crossover voxels or None (CPU at every size)}, {} when there is
+    #no table or it was measured on another device.
+    try:
+        with open(path) as fp:
+            table = json.load(fp)
+        if table["device"] != _device():
+            return {}
+        return table["crossover"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def saveTable(crossover, path=TABLE_PATH):
+    #crossover = {op: voxels from which CUDA is faster, None if never}
+    global _table
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fp:
+        json.dump({"device": _device(), "crossover": crossover}, fp, indent=1, sort_keys=True)
+    _table = dict(crossover)
+
+def backendFor(op, size):
+    #op = operation name (the function that dispatches)
+    #size = number of voxels it works on
+    #Outputs "cuda" or "cpu".
+    global _table
+    if not CUDA_AVAILABLE:
+        return "cpu"
+    choice = _forced or BACKEND_OVERRIDES.get(op, BACKEND)
+    if choice in ("cpu", "cuda"):
+        return choice
+    if _table is None:
+        _table = loadTable()
+    crossover = _table.get(op, DEFAULT_CROSSOVER)
+    return "cuda" if crossover is not None and size >= crossover else "cpu"
+
+def useCuda(op, size):
+    return backendFor(op, size) == "cuda"
+
+@contextmanager
+def forced(choice):
+    #Runs the enclosed calls on one backend regardless of table and overrides (calibration).
+    global _forced
+    previous, _forced = _forced, choice
+    try:
+        yield
+    finally:
+        _forced = previous
@@ -0,0 +1,203 @@
+import contextlib
+import io
+import sys
+import time
+import numpy as np
+import backend
+import csg
+import Frep as f
+import narrowBand as nb
+import SDF3D as sdf
+from SDF3D import SDF3D, jumpFlood, jumpFloodLabels, seedDistance, simplify, xHeight
+from SDF3D import _jump_flood_edt, _jump_flood_numba, _sdf3d_cpu, _sdf3d_scipy
+from voronize import strutFinder, strutDistance, activeMask
+from pointGen import genRandPoints
+from analysis import findVol
+from voxelize import toFRep
+from meshExport import tesselate
+
+# Times the CPU kernels on random seed grids. Run as
+#   python benchmark.py [size ...]
+# The numbers back the engine choices made in the CPU fallbacks, and the int16
+# report bounds the error of FIELD_DTYPE = "int16" against float32.
+#   python benchmark.py --calibrate [size ...]
+# times every dispatched operation on both backends and writes the CPU/CUDA
+# crossover table that backend.py reads.
+
+def timeit(fn, *args, repeat=3):
+    #Best wall time of repeat calls, after one warm-up call (numba compiles on first use).
+    fn(*args)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def seedGrid(size, density=0.001, seed=0):
+    #Same format as genRandPoints: 0 at each seed, 1 elsewhere.
+    rng = np.random.default_rng(seed)
+    return np.where(rng.random((size, size, size)) < density, 0, 1).astype(np.float32)
+
+def benchJumpFlood(sizes):
+    print("Jump flood (seconds)")
+    print("size    edt     jfa L2  jfa L1")
+    for size in sizes:
+        seeds = seedGrid(size)
+        edt = timeit(_jump_flood_edt, seeds)
+        jfa = timeit(_jump_flood_numba, seeds, 2.0)
+        jfa1 = timeit(_jump_flood_numba, seeds, 1.0)
+        print(f"{size:<7} {edt:<7.3f} {jfa:<7.3f} {jfa1:<7.3f}")
+
+def benchSDF3D(sizes):
+    #Compares the compiled EDT in _sdf3d_cpu with the two scipy transforms it replaced.
+    print("SDF3D (seconds)")
+    print("size    scipy   numba   max |diff|")
+    for size in sizes:
+        rng = np.random.default_rng(size)
+        field = (rng.random((size, size, size)) - 0.7).astype(np.float32)
+        field = _sdf3d_scipy(field, 2.0) - 3.0 #Blobs a few voxels thick, like condensed models
+        ref = timeit(_sdf3d_scipy, field, 2.0)
+        new = timeit(_sdf3d_cpu, field, 2.0)
+        diff = np.abs(_sdf3d_scipy(field, 2.0) - _sdf3d_cpu(field, 2.0)).max()
+        print(f"{size:<7} {ref:<7.3f} {new:<7.3f} {diff:.2e}")
+
+def blobField(size, count=20):
+    #Exact SDF of count random spheres, radii up to a tenth of the grid.
+    rng = np.random.default_rng(size)
+    x = np.arange(size, dtype=np.float32)
+    field = np.full((size, size, size), np.inf, dtype=np.float32)
+    for cx, cy, cz, r in rng.random((count, 4))*[size, size, size, size/10]:
+        d = np.sqrt((x[:, None, None]-cx)**2 + (x[None, :, None]-cy)**2 + (x[None, None, :]-cz)**2)
+        np.minimum(field, d - r - 2, out=field)
+    return field
+
+def benchQuantize(sizes):
+    #Accuracy of int16 fields against float32: stored distances and signs, then a
+    #union + shell evaluated on the int16 leaves, its sign changes and mesh vertices.
+    print("int16 fields vs float32")
+    print("size    max |err|  flips  op |err|   op flips  verts f32/i16   bytes")
+    for size in sizes:
+        a = blobField(size)
+        b = np.ascontiguousarray(np.flip(a, 0))
+        qa, qb = csg.quantize(a), csg.quantize(b)
+        reach = qa.reach
+        err = np.abs(qa.toDense() - np.clip(a, -reach, reach)).max()
+        stored = int(np.count_nonzero(np.sign(qa.data) != np.sign(a)))
+        ref = csg.shell(csg.union(a, b), 2).evaluate()
+        op = csg.shell(csg.union(qa, qb), 2).evaluate()
+        opErr = np.abs(op.toDense() - np.clip(ref, -reach, reach)).max()
+        flips = int(np.count_nonzero(np.sign(op.data) != np.sign(ref)))
+        axis = np.arange(size)
+        verts = tesselate(ref, axis, axis, axis, (1, 1, 1))[0].shape[0]
+        qverts = tesselate(op, axis, axis, axis, (1, 1, 1))[0].shape[0]
+        print(f"{size:<7} {err:<10.2e} {stored:<6} {opErr:<10.2e} {flips:<9} {verts}/{qverts:<10} {op.nbytes/ref.nbytes:.2f}")
+
+def checkMaskedLabels(size=100):
+    #Regression check for the active mask in jumpFloodLabels: two active regions
+    #(a seeded slab and a small blob far from it) separated by inactive bricks
+    #must get the same nearest-seed distances as an unmasked flood, on every engine.
+    seeds = seedGrid(size, density=0.01)
+    seeds[size//10:] = 1
+    obj = np.ones((size, size, size), dtype=np.float32)
+    obj[:size//10] = -1
+    mid = size//2
+    obj[size*6//10:size*6//10+3, mid:mid+3, mid:mid+3] = -1
+    active = activeMask(SDF3D(obj), 2)
+    print("Masked labels vs unmasked (voxels with a farther seed)")
+    engine = sdf.JF_CPU_ENGINE
+    try:
+        for name in ("jfa", "edt", "auto"):
+            sdf.JF_CPU_ENGINE = name
+            with backend.forced("cpu"):
+                full = seedDistance(*jumpFloodLabels(seeds, 2.0))
+                masked = seedDistance(*jumpFloodLabels(seeds, 2.0, active))
+            wrong = int(np.count_nonzero(masked[active] > full[active] + 1e-4))
+            print(f"{name:<7} {wrong}")
+    finally:
+        sdf.JF_CPU_ENGINE = engine
+
+def checkBandTrees(size=64):
+    #Regression check for csg trees mixing a narrow-band strut field with dense
+    #subtrees, as voronize's model shell and main's AESTHETIC rim build them.
+    obj = blobField(size)
+    struts = np.ones_like(obj)
+    struts[size//2] = -1
+    band = nb.NarrowBandField.fromDense(strutDistance(struts, 4), 4)
+    dense = band.toDense()
+    cases = {
+        "shell": (csg.union(csg.shell(obj, 2), band), np.minimum(np.maximum(obj, -obj - 2), dense)),
+        "thicken": (csg.union(band, csg.thicken(obj, -5)), np.minimum(dense, obj + 5)),
+    }
+    print("Band trees vs dense (voxels with a different sign)")
+    for name, (expr, expected) in cases.items():
+        wrong = int(np.count_nonzero((expr.evaluate().toDense() <= 0) != (expected <= 0)))
+        print(f"{name:<7} {wrong}")
+
+# Per dispatched operation: the call timed on each backend, from the inputs of calibrate().
+CALIBRATION_OPS = {
+    "smooth": lambda g: f.smooth(g["field"]),
+    "translate": lambda g: f.translate(g["field"], 1, 0, 0),
+    "combineShifted": lambda g: f.combineShifted(g["field"], -1, 0, 0),
+    "projection": lambda g: f.projection(g["field"]),
+    "condense": lambda g: f.condense(g["field"], 1),
+    "csg": lambda g: f.union(g["field"], g["other"]),
+    "jumpFlood": lambda g: jumpFlood(g["seeds"], 2.0),
+    "jumpFloodLabels": lambda g: jumpFloodLabels(g["seeds"], 2.0),
+    "SDF3D": lambda g: SDF3D(g["field"]),
+    "simplify": lambda g: simplify(g["field"]),
+    "xHeight": lambda g: xHeight(g["field"]),
+    "strutFinder": lambda g: strutFinder(g["labels"]),
+    "strutDistance": lambda g: strutDistance(g["struts"], 4),
+    "genRandPoints": lambda g: genRandPoints(g["field"], 0.3),
+    "findVol": lambda g: findVol(g["field"], [1, 1, 1], 1, "Calibration"),
+    "toFRep": lambda g: toFRep(g["binary"]),
+}
+
+def calibrate(sizes):
+    #Times each operation on the CPU and on CUDA and stores, per operation, the
+    #smallest grid from which CUDA stays faster (None when it never is).
+    if not backend.CUDA_AVAILABLE:
+        print("CUDA is not available; every operation runs on the CPU.")
+        return
+    sizes = sorted(sizes)
+    inputs = []
+    for size in sizes:
+        #The kernels expect an empty margin around the part, as after voxelize.
+        field = np.pad(blobField(size - 16), 8, constant_values=np.float32(8))
+        seeds = seedGrid(size)
+        with backend.forced("cpu"):
+            labels = jumpFloodLabels(seeds, 2.0)[0]
+            struts = strutFinder(labels)
+        inputs.append({"field": field, "other": np.ascontiguousarray(np.flip(field, 0)), "seeds": seeds,
+                       "labels": labels, "struts": struts, "binary": (field <= 0).astype(np.float32)})
+    print("Backend calibration (seconds)")
+    print("op               size    cpu     cuda")
+    crossover = {}
+    for op, call in CALIBRATION_OPS.items():
+        faster = []
+        for size, grids in zip(sizes, inputs):
+            times = []
+            for choice in ("cpu", "cuda"):
+                with backend.forced(choice), contextlib.redirect_stdout(io.StringIO()):
+                    times.append(timeit(call, grids))
+            faster.append(times[1] < times[0])
+            print(f"{op:<16} {size:<7} {times[0]:<7.3f} {times[1]:<7.3f}")
+        crossover[op] = None
+        for index in range(len(sizes) - 1, -1, -1):
+            if not faster[index]:
+                break
+            crossover[op] = sizes[index]**3
+    backend.saveTable(crossover)
+    print("Crossover table written to " + backend.TABLE_PATH)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ["--calibrate"]:
+        calibrate([int(arg) for arg in sys.argv[2:]] or [32, 64, 96, 128, 192])
+        sys.exit()
+    sizes = [int(arg) for arg in sys.argv[1:]] or [64, 128]
+    benchJumpFlood(sizes)
+    benchSDF3D(sizes)
+    benchQuantize(sizes)
+    checkMaskedLabels()
+    checkBandTrees()
@@ -0,0 +1,33 @@
+import numpy as np
+
+# Reusable float32 scratch grids. Full-size temporaries in voronize and main
+# are taken from the pool and given back once consumed, so consecutive stages
+# on the same grid reuse one allocation instead of each growing the heap.
+
+class BufferPool:
+    def __init__(self):
+        self._free = {}
+
+    def take(self, shape):
+        #Outputs an uninitialised float32 array of the given shape, reusing a free one if possible.
+        free = self._free.get(tuple(shape))
+        if free:
+            return free.pop()
+        return np.empty(shape, dtype=np.float32)
+
+    def give(self, *arrays):
+        #Hands arrays back once nothing reads them any more. Only plain float32
+        #arrays that own their memory are kept; anything else is left to the GC.
+        for array in arrays:
+            if (type(array) is np.ndarray and array.dtype == np.float32
+                    and array.base is None and array.flags.c_contiguous):
+                self._free.setdefault(array.shape, []).append(array)
+
+    def clear(self):
+        #Drops every free buffer, e.g. before meshing when no more grids of these shapes are needed.
+        self._free.clear()
+
+    def nbytes(self):
+        return sum(array.nbytes for free in self._free.values() for array in free)
+
+pool = BufferPool()
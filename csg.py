@@ -0,0 +1,308 @@
+from numba import cuda
+import hashlib
+import importlib.util
+import os
+import sys
+import numpy as np
+import narrowBand as nb
+from backend import useCuda
+import userInput as u
+from quantize import QuantizedField, isQuantized, asFloat, FIELD_STEP, LIMIT
+try: TPB = u.TPB
+except: TPB = 8
+
+# Lazy CSG expressions over voxel fields. union/intersection/subtract/thicken/
+# shell build a small tree instead of a new array; evaluate() turns the tree
+# into the source of one fused kernel (numba prange on CPU, CUDA otherwise),
+# runs it once and writes a single float32 output. Kernels are generated per
+# tree shape, written to KERNEL_DIR keyed by a hash of their source, and
+# compiled with numba's on-disk cache, so each shape is compiled once.
+# Analytic primitives (sphere, rect, cylinders, heart, egg) are leaves too,
+# evaluated inside the same kernel from their 1D axis vectors; slab() cuts a
+# tree down to a range of X layers so a scene can be evaluated tile by tile.
+# QuantizedField leaves are decoded in the kernel and a QuantizedField output
+# is encoded there too, so int16 grids never pass through a float32 copy.
+
+KERNEL_DIR = os.path.join(os.path.dirname(__file__), 'Cache', 'csg')
+
+class Expr:
+    def evaluate(self, out=None):
+        #out = optional float32 array to write into
+        return evaluate(self, out)
+
+    @property
+    def shape(self):
+        return self.children[0].shape
+
+class Leaf(Expr):
+    def __init__(self, field):
+        self.field = field
+        self.children = ()
+
+    @property
+    def shape(self):
+        return self.field.shape
+
+class Op(Expr):
+    def __init__(self, name, children, params=()):
+        #name = one of _EMIT's keys, children = Exprs, params = float parameters
+        self.name = name
+        self.children = tuple(children)
+        self.params = tuple(float(param) for param in params)
+
+class Primitive(Expr):
+    def __init__(self, kind, axes, params=()):
+        #kind = one of _PRIMITIVE's keys, axes = (x, y, z) coordinate vectors
+        self.kind = kind
+        self.axes = tuple(np.asarray(axis) for axis in axes)
+        self.params = tuple(float(param) for param in params)
+        self.children = ()
+
+    @property
+    def shape(self):
+        return tuple(len(axis) for axis in self.axes)
+
+def lift(u):
+    #Wraps arrays, NarrowBandFields and QuantizedFields as leaves, passes expressions through.
+    return u if isinstance(u, Expr) else Leaf(u)
+
+def union(u, v):
+    return Op("union", (lift(u), lift(v)))
+
+def intersection(u, v):
+    return Op("intersection", (lift(u), lift(v)))
+
+def subtract(u, v):
+    #u = cutting tool, v = base model
+    return Op("subtract", (lift(u), lift(v)))
+
+def thicken(u, weight):
+    return Op("thicken", (lift(u),), (weight,))
+
+def shell(u, sT):
+    return Op("shell", (lift(u),), (sT,))
+
+def negate(u):
+    return Op("negate", (lift(u),))
+
+#x,y,z = coordinate vectors of the grid the shape lives in, as in Frep
+def sphere(x, y, z, rad):
+    return Primitive("sphere", (x, y, z), (rad,))
+
+def rect(x, y, z, xl, yl, zl, origin=(0, 0, 0)):
+    return Primitive("rect", (x, y, z), (xl, yl, zl, *origin))
+
+def cylinderX(x, y, z, start, stop, rad):
+    return Primitive("cylinderX", (x, y, z), (start, stop, rad))
+
+def cylinderY(x, y, z, start, stop, rad):
+    return Primitive("cylinderY", (x, y, z), (start, stop, rad))
+
+def heart(x, y, z, cx, cy, cz):
+    return Primitive("heart", (x, y, z), (cx, cy, cz))
+
+def egg(x, y, z, cx, cy, cz):
+    return Primitive("egg", (x, y, z), (cx, cy, cz))
+
+# Per op: source of the node value from its children's variables (c0, c1) and
+# its parameter names (p0), same formulas as the eager Frep versions.
+_EMIT = {
+    "union": lambda c, p: f"min({c[0]}, {c[1]})",
+    "intersection": lambda c, p: f"max({c[0]}, {c[1]})",
+    "subtract": lambda c, p: f"max(-{c[0]}, {c[1]})",
+    "thicken": lambda c, p: f"{c[0]} - {p[0]}",
+    "shell": lambda c, p: f"max({c[0]}, -{c[0]} - {p[0]})",
+    "negate": lambda c, p: f"-{c[0]}",
+}
+
+# Per primitive: source of the value from the coordinate expressions x, y, z and
+# parameter names p, same formulas as the Frep CUDA kernels.
+_PRIMITIVE = {
+    "sphere": lambda x, y, z, p: f"math.sqrt({x}**2 + {y}**2 + {z}**2) - {p[0]}",
+    "rect": lambda x, y, z, p: (f"max(abs({x} - {p[3]}) - {p[0]}/2, abs({y} - {p[4]}) - {p[1]}/2, "
+                                f"abs({z} - {p[5]}) - {p[2]}/2)"),
+    "cylinderX": lambda x, y, z, p: f"max(({x} - {p[0]})*({x} - {p[1]}), math.sqrt({y}**2 + {z}**2) - {p[2]})",
+    "cylinderY": lambda x, y, z, p: f"max(({y} - {p[0]})*({y} - {p[1]}), math.sqrt({x}**2 + {z}**2) - {p[2]})",
+    "heart": lambda x, y, z, p: (f"(({x} - {p[0]})**2 + 9*({y} - {p[1]})**2/4 + ({z} - {p[2]})**2 - 1)**3"
+                                 f" - ({x} - {p[0]})**2*({z} - {p[2]})**3 - 9*({y} - {p[1]})**2*({z} - {p[2]})**3/80"),
+    "egg": lambda x, y, z, p: (f"9*({x} - {p[0]})**2 + 16*(({y} - {p[1]})**2 + ({z} - {p[2]})**2)"
+                               f" + 2*({x} - {p[0]})*(({y} - {p[1]})**2 + ({z} - {p[2]})**2)"
+                               f" + (({y} - {p[1]})**2 + ({z} - {p[2]})**2) - 144"),
+}
+
+_BAND = {
+    "union": lambda c, p: nb.union(*c),
+    "intersection": lambda c, p: nb.intersection(*c),
+    "subtract": lambda c, p: nb.subtract(*c),
+    "thicken": lambda c, p: nb.thicken(c[0], p[0]),
+    "shell": lambda c, p: nb.shell(c[0], p[0]),
+    "negate": lambda c, p: nb.negate(c[0]),
+}
+
+def _leaves(expr, found):
+    if isinstance(expr, Leaf):
+        found.append(expr.field)
+    for child in expr.children:
+        _leaves(child, found)
+    return found
+
+def _evaluate_band(expr):
+    #Narrow-band trees go node by node through the brick-wise narrowBand ops.
+    #Subtrees without a band leaf (primitives, shells of the dense model) are
+    #evaluated densely in one fused kernel and join the band ops as operands.
+    if not any(nb.isBand(leaf) for leaf in _leaves(expr, [])):
+        return asFloat(evaluate(expr))
+    if isinstance(expr, Leaf):
+        return expr.field
+    return _BAND[expr.name]([_evaluate_band(child) for child in expr.children], expr.params)
+
+def _check_shape(expr, shape):
+    #The fused kernel indexes every operand with the output's i,j,k, so a
+    #mismatched leaf would be read out of bounds instead of failing.
+    if isinstance(expr, (Leaf, Primitive)) and tuple(expr.shape) != tuple(shape):
+        raise ValueError(f"CSG operands must match the output shape {tuple(shape)}, got {tuple(expr.shape)}")
+    for child in expr.children:
+        _check_shape(child, shape)
+
+def _lower(expr):
+    #Flattens the tree into straight-line statements. Identical arrays become one
+    #argument; every parameter becomes a scalar argument so values do not change the source.
+    arrays, scalars, lines = [], [], []
+    def argument(array):
+        for index, known in enumerate(arrays):
+            if known is array:
+                return f"a{index}"
+        arrays.append(array)
+        return f"a{len(arrays)-1}"
+    def scalar(value):
+        scalars.append(value)
+        return f"s{len(scalars)-1}"
+    def visit(node):
+        if isinstance(node, Leaf):
+            if isQuantized(node.field):
+                return f"({argument(node.field.data)}[i,j,k]*{scalar(node.field.step)})"
+            return argument(node.field) + "[i,j,k]"
+        params = [scalar(param) for param in node.params]
+        name = f"t{len(lines)}"
+        if isinstance(node, Primitive):
+            x, y, z = [argument(axis) + f"[{index}]" for axis, index in zip(node.axes, "ijk")]
+            lines.append(f"{name} = {_PRIMITIVE[node.kind](x, y, z, params)}")
+            return name
+        children = [visit(child) for child in node.children]
+        lines.append(f"{name} = {_EMIT[node.name](children, params)}")
+        return name
+    result = visit(expr)
+    return arrays, scalars, lines, result
+
+def _encode(result, inverse):
+    #Statements storing result as a saturated int16 count of steps (inverse = 1/step
+    #scalar). Nonzero values never round to 0, so the sign survives.
+    return [f"r = {result}", f"q = round(r*{inverse})",
+            f"if q > {LIMIT}:", f"    q = {LIMIT}",
+            f"elif q < -{LIMIT}:", f"    q = -{LIMIT}",
+            "elif q == 0 and r != 0:", "    q = 1 if r > 0 else -1"], "q"
+
+def _source(nArrays, nScalars, lines, result, target):
+    args = ", ".join(["out"] + [f"a{i}" for i in range(nArrays)] + [f"s{i}" for i in range(nScalars)])
+    if target == "cpu":
+        head = ["import math", "from numba import njit, prange", "",
+                "@njit(parallel=True, cache=True)", f"def kernel({args}):",
+                "    m, n, p = out.shape", "    for i in prange(m):",
+                "        for j in range(n):", "            for k in range(p):"]
+        pad = " "*16
+    else:
+        head = ["import math", "from numba import cuda", "",
+                "@cuda.jit", f"def kernel({args}):",
+                "    i, j, k = cuda.grid(3)", "    m, n, p = out.shape",
+                "    if i < m and j < n and k < p:"]
+        pad = " "*8
+    body = [pad + line for line in lines] + [pad + f"out[i,j,k] = {result}"]
+    return "\n".join(head + body) + "\n"
+
+_kernels = {}
+
+def _compile(source):
+    #Loads the kernel for this source, writing it to KERNEL_DIR on first use.
+    if source in _kernels:
+        return _kernels[source]
+    digest = hashlib.sha256(source.encode()).hexdigest()[:16]
+    os.makedirs(KERNEL_DIR, exist_ok=True)
+    path = os.path.join(KERNEL_DIR, f"csg_{digest}.py")
+    if not os.path.exists(path):
+        tmp = path + ".tmp%d" % os.getpid()
+        with open(tmp, "w") as fp:
+            fp.write(source)
+        os.replace(tmp, path)
+    spec = importlib.util.spec_from_file_location(f"csg_{digest}", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module #numba's disk cache re-imports the module by name
+    spec.loader.exec_module(module)
+    _kernels[source] = module.kernel
+    return module.kernel
+
+def slab(expr, start, stop):
+    #Outputs the same tree restricted to X layers [start, stop): field leaves are
+    #sliced, primitives keep their Y and Z vectors and slice the X one.
+    if isinstance(expr, Leaf):
+        if isQuantized(expr.field):
+            return Leaf(QuantizedField(expr.field.data[start:stop], expr.field.step))
+        return Leaf(np.asarray(expr.field[start:stop]))
+    if isinstance(expr, Primitive):
+        x, y, z = expr.axes
+        return Primitive(expr.kind, (x[start:stop], y, z), expr.params)
+    return Op(expr.name, [slab(child, start, stop) for child in expr.children], expr.params)
+
+def evaluate(expr, out=None):
+    #expr = Expr (or a plain field, returned unchanged)
+    #out = optional float32 array or QuantizedField for the result, may alias a leaf
+    #Outputs the field as a float32 array, a NarrowBandField when any leaf is one,
+    #or a QuantizedField when out is one or (without out) any leaf is one.
+    if not isinstance(expr, Expr):
+        return expr
+    if isinstance(expr, Leaf) and out is None:
+        return expr.field
+    leaves = _leaves(expr, [])
+    if any(nb.isBand(leaf) for leaf in leaves):
+        return _evaluate_band(expr)
+    shape = expr.shape if out is None else out.shape
+    _check_shape(expr, shape)
+    if out is None:
+        steps = [leaf.step for leaf in leaves if isQuantized(leaf)]
+        if steps:
+            out = QuantizedField.empty(shape, steps[0])
+    arrays, scalars, lines, result = _lower(expr)
+    target = out
+    if isQuantized(out):
+        scalars.append(1/out.step)
+        encode, result = _encode(result, f"s{len(scalars)-1}")
+        lines = lines + encode
+        target = out.data
+    if not useCuda("csg", int(np.prod(shape))):
+        kernel = _compile(_source(len(arrays), len(scalars), lines, result, "cpu"))
+        if target is None:
+            out = target = np.empty(shape, dtype=np.float32)
+        kernel(target, *arrays, *[np.float32(s) for s in scalars])
+        return out
+    kernel = _compile(_source(len(arrays), len(scalars), lines, result, "cuda"))
+    d_out = cuda.device_array(shape, dtype=np.float32 if target is None else target.dtype)
+    d_arrays = [cuda.to_device(np.ascontiguousarray(array)) for array in arrays]
+    gridSize = (
+        (shape[0] + TPB - 1) // TPB,
+        (shape[1] + TPB - 1) // TPB,
+        (shape[2] + TPB - 1) // TPB,
+    )
+    blockSize = (TPB, TPB, TPB)
+    kernel[gridSize, blockSize](d_out, *d_arrays, *[np.float32(s) for s in scalars])
+    if target is None:
+        return d_out.copy_to_host()
+    d_out.copy_to_host(target)
+    return out
+
+def quantize(u, step=FIELD_STEP, out=None):
+    #u = dense field or Expr
+    #step = voxels per int16 unit, distances beyond 32767*step saturate
+    #Outputs u as a QuantizedField (into out when given).
+    expr = lift(u)
+    if out is None:
+        out = QuantizedField.empty(expr.shape, step)
+    return evaluate(expr, out)
@@ -3,14 +3,22 @@ import sys
 import time
 import numpy as np
 import Frep as f
+import csg
+import narrowBand as nb
 import userInput as u
+from bufferPool import pool
+from quantize import FIELD_STEP
 from voronize import voronize, surface_voronoi_net
 from SDF3D import SDF3D, xHeight
 from pointGen import genRandPoints, explode
 from meshExport import generateMesh
 from analysis import findVol
 from visualizeSlice import slicePlot, contourPlot, generateImageStack
-from voxelize import voxelize
+from voxelize import voxelize, VOXELIZER_VERSION
+from meshSDF import meshToSDF, MESH_SDF_VERSION, SDF_CELL
+from voxelCache import cacheKey, loadCached, storeCached
+from supportColumns import supportColumns, tableColumns
+from tiled import tiledEvaluate, tiledVoxelize, tiledCondense, tiledSDF3D, tiledRandPoints, tiledVoronize, tiledSmooth, tiledMap, TILE_HALO_VOX
 
 
 def format_param(value):
@@ -26,6 +34,19 @@ def mm_to_voxels(mm_value, voxel_size_mm):
         return mm_value
     return mm_value / voxel_size_mm
 
+
+def compact(field):
+    """Store a finished strut field as int16 steps when FIELD_DTYPE is "int16".
+
+    Only plain in-memory grids are converted; the float32 grid goes back to the
+    buffer pool for the next voronize.
+    """
+    if getattr(u, "FIELD_DTYPE", "float32") != "int16" or type(field) is not np.ndarray:
+        return field
+    quantized = csg.quantize(field, FIELD_STEP)
+    pool.give(field)
+    return quantized
+
 def main():
     start = time.time()
     try:    os.mkdir(os.path.join(os.path.dirname(__file__),'Output')) #Creates an output folder if there isn't one yet
@@ -49,6 +70,11 @@ def main():
     show_plots = getattr(u, "SHOW_PLOTS", True)
     auto_export = getattr(u, "AUTO_EXPORT", False)
     run_label = getattr(u, "RUN_LABEL", "")
+    direct_sdf = getattr(u, "DIRECT_SDF", False)
+    use_cache = getattr(u, "VOXEL_CACHE", True)
+    tiled = getattr(u, "MEMORY_BUDGET_MB", 0) > 0
+    support_columns = getattr(u, "SUPPORT_COLUMNS", True)
+    cached = None
 
     if cli_path:
         candidate_paths = [
@@ -71,43 +97,79 @@ def main():
         modelImport = True
     elif PRIMITIVE_TYPE != "":
         shortName = PRIMITIVE_TYPE
+        #Primitives are built as a csg scene and evaluated once below, in slabs when tiled.
         if PRIMITIVE_TYPE == "Heart":
             x0 = np.linspace(-1.5,1.5,u.RESOLUTION)
             y0, z0 = x0, x0
-            origShape = f.heart(x0,y0,z0,0,0,0)
+            scene = csg.heart(x0,y0,z0,0,0,0)
         elif PRIMITIVE_TYPE == "Egg":
             x0 = np.linspace(-5,5,u.RESOLUTION)
             y0, z0 = x0, x0
-            origShape = f.egg(x0,y0,z0,0,0,0)
+            scene = csg.egg(x0,y0,z0,0,0,0)
             #eggknowledgement to Molly Carton for this feature.
         else:
             x0 = np.linspace(-50,50,u.RESOLUTION)
             y0, z0 = x0, x0
             if PRIMITIVE_TYPE == "Cube":
-                origShape = f.rect(x0,y0,z0,80,80,80)
+                scene = csg.rect(x0,y0,z0,80,80,80)
             elif PRIMITIVE_TYPE == "Silo":
-                origShape = f.union(f.sphere(x0,y0,z0,40),f.cylinderY(x0,y0,z0,-40,0,40))
+                scene = csg.union(csg.sphere(x0,y0,z0,40),csg.cylinderY(x0,y0,z0,-40,0,40))
             elif PRIMITIVE_TYPE == "Cylinder":
-                origShape = f.cylinderX(x0,y0,z0,-40,40,40)
+                scene = csg.cylinderX(x0,y0,z0,-40,40,40)
             elif PRIMITIVE_TYPE == "Sphere":
-                origShape = f.sphere(x0,y0,z0,40)
+                scene = csg.sphere(x0,y0,z0,40)
             else:
                 print("Selected primitive type has not yet been implemented.")
+                return
     else:
         print("Provide either a file name or a desired primitive.")
         return
 
+    if tiled and not (u.MODEL and not (u.SUPPORT or u.NET or u.AESTHETIC or (modelImport and direct_sdf))):
+        print("Tiled mode supports MODEL runs without SUPPORT, NET, AESTHETIC or DIRECT_SDF; running in memory.")
+        tiled = False
+
+    if not modelImport:
+        origShape = tiledEvaluate(scene) if tiled else scene.evaluate()
+
     if modelImport:
         res = max(int(u.RESOLUTION - buffer_vox*2), 1)
-        origShape, objectBox = voxelize(filepath, res, buffer_vox)
-        gridResX, gridResY, gridResZ = origShape.shape
+        if use_cache:
+            if tiled:
+                cache_key = cacheKey(filepath, res, buffer_vox, "voxelize-tiled", f"{VOXELIZER_VERSION}-halo{TILE_HALO_VOX}")
+            elif direct_sdf:
+                cache_key = cacheKey(filepath, res, buffer_vox, "meshSDF", f"{MESH_SDF_VERSION}-cell{SDF_CELL}")
+            else:
+                cache_key = cacheKey(filepath, res, buffer_vox, "voxelize", VOXELIZER_VERSION)
+            cached = loadCached(cache_key)
+        if cached is not None:
+            origShape, objectBox, gridShape = cached
+            print("Loaded voxelized model from cache.")
+        elif tiled:
+            origShape, objectBox = tiledVoxelize(filepath, res, buffer_vox)
+            gridShape = origShape.shape
+        elif direct_sdf:
+            origShape, objectBox = meshToSDF(filepath, res, buffer_vox)
+            gridShape = origShape.shape
+        else:
+            origShape, objectBox = voxelize(filepath, res, buffer_vox)
+            gridShape = origShape.shape
+        gridResX, gridResY, gridResZ = gridShape
         scale[0] = objectBox[0]/(gridResX-buffer_vox*2)
         scale[1] = max(objectBox[1:])/(gridResY-buffer_vox*2)
         scale[2] = scale[1]
         voxel_size_mm = float(np.mean(scale))
 
-    print("Initial Bounding Box Dimensions: "+str(origShape.shape))
-    origShape = SDF3D(f.condense(origShape,buffer_vox))
+    if cached is None:
+        print("Initial Bounding Box Dimensions: "+str(origShape.shape))
+        if tiled:
+            origShape = tiledSDF3D(tiledCondense(origShape,buffer_vox))
+        elif modelImport and direct_sdf:
+            origShape = f.condense(origShape,buffer_vox)
+        else:
+            origShape = SDF3D(f.condense(origShape,buffer_vox))
+        if modelImport and use_cache:
+            storeCached(cache_key, origShape, objectBox, gridShape)
     print("Condensed Bounding Box Dimensions: "+str(origShape.shape))
 
     model_cell_vox = mm_to_voxels(u.MODEL_CELL_MM, voxel_size_mm)
@@ -116,20 +178,30 @@ def main():
     net_thickness_vox = mm_to_voxels(u.NET_THICKNESS_MM, voxel_size_mm)
     
     if u.SUPPORT:
-        projected = f.projection(origShape)
-        support = f.subtract(f.thicken(origShape,1),projected)
-        support = f.intersection(support, f.translate(support,-1,0,0))
+        if support_columns:
+            columns = supportColumns(origShape)
+            support = columns.rasterize()
+        else:
+            projected = f.projection(origShape)
+            support = f.subtract(f.thicken(origShape,1),projected)
+            support = f.erode(support,[(-1,0,0)],out=support)
         if show_plots:
             contourPlot(support,30,titlestring='Support',axis ="Z")
-        supportPts = genRandPoints(xHeight(support), u.SUPPORT_THRESH)
+        if support_columns:
+            supportPts = columns.randPoints(u.SUPPORT_THRESH)
+        else:
+            supportPts = genRandPoints(xHeight(support), u.SUPPORT_THRESH)
         supportVoronoi = voronize(support, supportPts, support_cell_vox, 0, scale, name = "Support", sliceAxis = "Z")
         if u.PERFORATE: 
-            explosion = f.union(explode(supportPts), f.translate(explode(supportPts),-1,0,0))
-            explosion = f.union(explosion,f.translate(explosion,0,1,0))
-            explosion = f.union(explosion,f.translate(explosion,0,0,1))
-            supportVoronoi = f.subtract(explosion,supportVoronoi)
-        table = f.subtract(f.thicken(origShape,1),f.intersection(f.translate(f.subtract(origShape,f.translate(origShape,-3,0,0)),-1,0,0),projected))
-        supportVoronoi = f.union(table,supportVoronoi)
+            explosion = explode(supportPts, out=pool.take(supportPts.shape))
+            explosion = f.dilate(explosion,[(-1,0,0),(0,1,0),(0,0,1)],out=explosion)
+            supportVoronoi = f.subtract(explosion,supportVoronoi,out=explosion)
+        if support_columns:
+            table = tableColumns(origShape).rasterize()
+        else:
+            below = f.translate(f.subtract(origShape,f.translate(origShape,-3,0,0)),-1,0,0)
+            table = csg.subtract(csg.thicken(origShape,1),csg.intersection(below,projected)).evaluate()
+        supportVoronoi = compact(f.union(table,supportVoronoi,out=table))
         findVol(supportVoronoi,scale,u.MAT_DENSITY,"Support")
     
     if u.MODEL:
@@ -139,38 +211,46 @@ def main():
                 volumePts = genRandPoints(origShape,u.MODEL_THRESH)
                 print("Points Generated (volume)!")
                 volumeVoronoi = voronize(origShape, volumePts, model_cell_vox, model_shell_vox, scale, name = "Object Interior")
-                objectVoronoi = f.union(surfaceNet, volumeVoronoi)
+                objectVoronoi = f.union(surfaceNet, volumeVoronoi, out=volumeVoronoi)
             else:
                 objectVoronoi = surfaceNet
+            objectVoronoi = compact(objectVoronoi)
             findVol(objectVoronoi, scale, u.MAT_DENSITY, "Object")
         else:
             if u.AESTHETIC:
                 objectPts = genRandPoints(f.shell(origShape,5),u.MODEL_THRESH)
+            elif tiled:
+                objectPts = tiledRandPoints(origShape,u.MODEL_THRESH)
             else:
                 objectPts = genRandPoints(origShape,u.MODEL_THRESH)
             print("Points Generated!")
-            objectVoronoi = voronize(origShape, objectPts, model_cell_vox, model_shell_vox, scale, name = "Object")
+            if tiled:
+                objectVoronoi = tiledVoronize(origShape, objectPts, model_cell_vox, model_shell_vox, scale, name = "Object")
+            else:
+                objectVoronoi = compact(voronize(origShape, objectPts, model_cell_vox, model_shell_vox, scale, name = "Object"))
             findVol(objectVoronoi,scale,u.MAT_DENSITY,"Object") #in mm^3
             if u.AESTHETIC:
-                objectVoronoi = f.union(objectVoronoi,f.thicken(origShape,-5))
+                objectVoronoi = csg.union(objectVoronoi,csg.thicken(origShape,-5)).evaluate()
     shortName = shortName+"_Voronoi"
     if u.SUPPORT and u.MODEL:
         complete = f.union(objectVoronoi,supportVoronoi)
         if u.IMG_STACK:
-            generateImageStack(objectVoronoi,[255,0,0],supportVoronoi,[0,0,255],name = shortName)
+            generateImageStack(nb.asDense(objectVoronoi),[255,0,0],nb.asDense(supportVoronoi),[0,0,255],name = shortName)
     elif u.SUPPORT:
         complete = supportVoronoi
         if u.IMG_STACK:
-            generateImageStack(supportVoronoi,[0,0,0],supportVoronoi,[0,0,255],name = shortName)
+            generateImageStack(nb.asDense(supportVoronoi),[0,0,0],nb.asDense(supportVoronoi),[0,0,255],name = shortName)
     elif u.MODEL:
         complete = objectVoronoi
         if u.IMG_STACK:
-            generateImageStack(objectVoronoi,[255,0,0],objectVoronoi,[0,0,0],name = FILE_NAME[:-4])
+            generateImageStack(nb.asDense(objectVoronoi),[255,0,0],nb.asDense(objectVoronoi),[0,0,0],name = FILE_NAME[:-4])
     if show_plots:
-        slicePlot(complete, origShape.shape[0]//2, titlestring='Full Model', axis = "X")
-        slicePlot(complete, origShape.shape[1]//2, titlestring='Full Model', axis = "Y")
-        slicePlot(complete, origShape.shape[2]//2, titlestring='Full Model', axis = "Z")
+        completeDense = nb.asDense(complete)
+        slicePlot(completeDense, origShape.shape[0]//2, titlestring='Full Model', axis = "X")
+        slicePlot(completeDense, origShape.shape[1]//2, titlestring='Full Model', axis = "Y")
+        slicePlot(completeDense, origShape.shape[2]//2, titlestring='Full Model', axis = "Z")
     
+    pool.clear() #Scratch grids are not reused past this point
     print("That took "+str(round(time.time()-start,2))+" seconds.")
     if not auto_export:
         print("AUTO_EXPORT disabled; skipping mesh export.")
@@ -203,13 +283,16 @@ def main():
         generateMesh(supportVoronoi, scale, modelName=base_name+"Support", decimate_keep=u.DECIMATE_KEEP_FRACTION)
     else:
         if u.SMOOTH:
-            complete = f.smooth(complete)
+            complete = tiledSmooth(complete) if tiled else f.smooth(complete)
         generateMesh(complete, scale, modelName=base_name, decimate_keep=u.DECIMATE_KEEP_FRACTION)
     if u.INVERSE and u.MODEL:
         print("Generating Inverse...")
-        inv=f.subtract(objectVoronoi,origShape)
+        if tiled:
+            inv = tiledMap(f.subtract, objectVoronoi, origShape)
+        else:
+            inv=f.subtract(objectVoronoi,origShape,out=objectVoronoi)
         if u.SMOOTH:
-            inv = f.smooth(inv)
+            inv = tiledSmooth(inv) if tiled else f.smooth(inv, out=inv)
         print("Generating Mesh...")
         generateMesh(inv, scale, modelName=base_name+"Inv", decimate_keep=u.DECIMATE_KEEP_FRACTION)
 
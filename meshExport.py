@@ -3,6 +3,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 from skimage import measure
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+import narrowBand as nb
+from quantize import isQuantized
+
+SLAB_VOXELS = 1 << 24 #Voxels per slab when meshing memory-mapped grids
 
 # Create 3d contourplot (and surface tesselation) based on 3d array fvals
 # sampled on grid with coords determined by xvals, yvals, and zvals
@@ -62,9 +66,12 @@ def exportPLY(modelName, verts2, faces):
     
 # Compute a tesselation of the zero isosurface
 def tesselate(fvals, xvals, yvals, zvals, scale):
-    verts, faces, normals, values = measure.marching_cubes(
-        fvals, level=0, spacing=(1.0, 1.0, 1.0), allow_degenerate=False
-    )
+    if nb.isBand(fvals) or isQuantized(fvals) or isinstance(fvals, np.memmap):
+        verts, faces = _marching_cubes_slabs(fvals)
+    else:
+        verts, faces, normals, values = measure.marching_cubes(
+            fvals, level=0, spacing=(1.0, 1.0, 1.0), allow_degenerate=False
+        )
     ndex = [0, 0, 0]
     frac = [0, 0, 0]
     verts2 = np.ndarray(shape=(verts.size // 3, 3), dtype=float)
@@ -78,6 +85,40 @@ def tesselate(fvals, xvals, yvals, zvals, scale):
     return tuple([verts2, faces])
 
 
+def _marching_cubes_slabs(field, slabBricks=4):
+    """Marching cubes over a NarrowBandField, QuantizedField or memory-mapped grid, one dense X slab at a time."""
+    if nb.isBand(field):
+        step = field.brick*slabBricks
+        getSlab = field.slab
+    elif isQuantized(field):
+        step = max(int(SLAB_VOXELS // max(field.shape[1]*field.shape[2], 1)), 1)
+        getSlab = field.slab
+    else:
+        step = max(int(SLAB_VOXELS // max(field.shape[1]*field.shape[2], 1)), 1)
+        getSlab = lambda start, stop: np.asarray(field[start:stop], dtype=np.float32)
+    all_verts, all_faces = [], []
+    count = 0
+    for start in range(0, field.shape[0] - 1, step):
+        # Slabs overlap by one layer so the cubes between them are not lost.
+        slab = getSlab(start, start + step + 1)
+        if slab.min() > 0 or slab.max() < 0:
+            continue
+        verts, faces, normals, values = measure.marching_cubes(
+            slab, level=0, spacing=(1.0, 1.0, 1.0), allow_degenerate=False
+        )
+        verts[:, 0] += start
+        all_verts.append(verts)
+        all_faces.append(faces + count)
+        count += verts.shape[0]
+    if not all_verts:
+        raise ValueError("Surface level must be within volume data range.")
+    verts = np.concatenate(all_verts)
+    faces = np.concatenate(all_faces)
+    # Vertices on the shared layers are generated twice; weld them back together.
+    verts, inverse = np.unique(verts, axis=0, return_inverse=True)
+    return verts, inverse.reshape(-1)[faces]
+
+
 def decimate_mesh(vertices, faces, keep_fraction):
     """Coarse voxel-grid decimation to reduce vertex/face counts."""
     keep_fraction = float(keep_fraction)
@@ -0,0 +1,197 @@
+from numba import njit, prange
+import math
+import numpy as np
+from scipy import ndimage
+from voxelize import loadScaledMesh, buildLayerIndex, sliceLayer
+import userInput as u
+SDF_CELL = getattr(u, "SDF_CELL", 4)
+MESH_SDF_VERSION = 1 #Bump when meshToSDF output changes, invalidates voxelCache entries
+
+# Computes the signed distance field of an STL directly from its triangles,
+# replacing voxelize -> toFRep -> condense -> SDF3D for imported models.
+# Distances within SDF_CELL voxels of the surface are exact point-triangle
+# distances found through a uniform grid of triangle buckets; farther voxels
+# measure the distance to the triangle nearest to their closest band voxel.
+# The sign comes from ray parity along the Y rows of every layer.
+
+@njit
+def _point_triangle_dist2(px, py, pz, tri):
+    #Squared distance from point p to triangle tri (Ericson, Real-Time Collision Detection 5.1.5).
+    ax, ay, az = tri[0,0], tri[0,1], tri[0,2]
+    abx, aby, abz = tri[1,0]-ax, tri[1,1]-ay, tri[1,2]-az
+    acx, acy, acz = tri[2,0]-ax, tri[2,1]-ay, tri[2,2]-az
+    apx, apy, apz = px-ax, py-ay, pz-az
+    d1 = abx*apx+aby*apy+abz*apz
+    d2 = acx*apx+acy*apy+acz*apz
+    if d1 <= 0.0 and d2 <= 0.0:
+        return apx*apx+apy*apy+apz*apz
+    bpx, bpy, bpz = px-tri[1,0], py-tri[1,1], pz-tri[1,2]
+    d3 = abx*bpx+aby*bpy+abz*bpz
+    d4 = acx*bpx+acy*bpy+acz*bpz
+    if d3 >= 0.0 and d4 <= d3:
+        return bpx*bpx+bpy*bpy+bpz*bpz
+    vc = d1*d4 - d3*d2
+    if vc <= 0.0 and d1 >= 0.0 and d3 <= 0.0:
+        v = d1/(d1-d3)
+        qx, qy, qz = apx-v*abx, apy-v*aby, apz-v*abz
+        return qx*qx+qy*qy+qz*qz
+    cpx, cpy, cpz = px-tri[2,0], py-tri[2,1], pz-tri[2,2]
+    d5 = abx*cpx+aby*cpy+abz*cpz
+    d6 = acx*cpx+acy*cpy+acz*cpz
+    if d6 >= 0.0 and d5 <= d6:
+        return cpx*cpx+cpy*cpy+cpz*cpz
+    vb = d5*d2 - d1*d6
+    if vb <= 0.0 and d2 >= 0.0 and d6 <= 0.0:
+        w = d2/(d2-d6)
+        qx, qy, qz = apx-w*acx, apy-w*acy, apz-w*acz
+        return qx*qx+qy*qy+qz*qz
+    va = d3*d6 - d5*d4
+    if va <= 0.0 and (d4-d3) >= 0.0 and (d5-d6) >= 0.0:
+        w = (d4-d3)/((d4-d3)+(d5-d6))
+        qx = bpx-w*(tri[2,0]-tri[1,0])
+        qy = bpy-w*(tri[2,1]-tri[1,1])
+        qz = bpz-w*(tri[2,2]-tri[1,2])
+        return qx*qx+qy*qy+qz*qz
+    denom = 1.0/(va+vb+vc)
+    v = vb*denom
+    w = vc*denom
+    qx, qy, qz = apx-v*abx-w*acx, apy-v*aby-w*acy, apz-v*abz-w*acz
+    return qx*qx+qy*qy+qz*qz
+
+@njit
+def _bin_triangles(tris, cellDims, cell, band):
+    #Buckets every triangle into the grid cells its bounding box (grown by band) overlaps.
+    #Returns CSR style offsets and triangle ids per cell.
+    nCells = cellDims[0]*cellDims[1]*cellDims[2]
+    counts = np.zeros(nCells+1, dtype=np.int64)
+    lo = np.empty((tris.shape[0], 3), dtype=np.int64)
+    hi = np.empty((tris.shape[0], 3), dtype=np.int64)
+    for t in range(tris.shape[0]):
+        for axis in range(3):
+            mn = min(tris[t,0,axis], tris[t,1,axis], tris[t,2,axis]) - band
+            mx = max(tris[t,0,axis], tris[t,1,axis], tris[t,2,axis]) + band
+            lo[t,axis] = min(max(int(math.floor(mn/cell)), 0), cellDims[axis]-1)
+            hi[t,axis] = min(max(int(math.floor(mx/cell)), 0), cellDims[axis]-1)
+        for i in range(lo[t,0], hi[t,0]+1):
+            for j in range(lo[t,1], hi[t,1]+1):
+                for k in range(lo[t,2], hi[t,2]+1):
+                    counts[(i*cellDims[1]+j)*cellDims[2]+k+1] += 1
+    offsets = np.cumsum(counts)
+    fill = offsets[:-1].copy()
+    ids = np.empty(offsets[-1], dtype=np.int32)
+    for t in range(tris.shape[0]):
+        for i in range(lo[t,0], hi[t,0]+1):
+            for j in range(lo[t,1], hi[t,1]+1):
+                for k in range(lo[t,2], hi[t,2]+1):
+                    c = (i*cellDims[1]+j)*cellDims[2]+k
+                    ids[fill[c]] = t
+                    fill[c] += 1
+    return offsets, ids
+
+@njit(parallel=True)
+def _band_distance(tris, offsets, ids, cellDims, cell, band, dist, nearest):
+    #Exact unsigned distance for every voxel within band of a triangle, -1 in nearest elsewhere.
+    m, n, p = dist.shape
+    band2 = band*band
+    for i in prange(m):
+        ci = min(i//cell, cellDims[0]-1)
+        for j in range(n):
+            cj = min(j//cell, cellDims[1]-1)
+            for k in range(p):
+                ck = min(k//cell, cellDims[2]-1)
+                c = (ci*cellDims[1]+cj)*cellDims[2]+ck
+                best = np.inf
+                bestT = -1
+                for s in range(offsets[c], offsets[c+1]):
+                    t = ids[s]
+                    d2 = _point_triangle_dist2(i, j, k, tris[t])
+                    if d2 < best:
+                        best = d2
+                        bestT = t
+                if best <= band2:
+                    dist[i,j,k] = math.sqrt(best)
+                    nearest[i,j,k] = bestT
+                else:
+                    nearest[i,j,k] = -1
+
+@njit(parallel=True)
+def _far_distance(tris, nearest, ind0, ind1, ind2, dist):
+    #Distance from each voxel outside the band to the triangle nearest its closest band voxel.
+    m, n, p = dist.shape
+    for i in prange(m):
+        for j in range(n):
+            for k in range(p):
+                if nearest[i,j,k] >= 0:
+                    continue
+                t = nearest[ind0[i,j,k], ind1[i,j,k], ind2[i,j,k]]
+                dist[i,j,k] = math.sqrt(_point_triangle_dist2(i, j, k, tris[t]))
+
+@njit(parallel=True)
+def _parity_fill(segments, pixels):
+    #Marks pixels whose (x,y) sample lies inside the layer outline, using the
+    #exact crossing positions along each x row (same relevance rules as _scanline_fill).
+    nx, ny = pixels.shape
+    s = segments.shape[0]
+    for x in prange(nx):
+        crossings = np.empty(s, dtype=np.float64)
+        count = 0
+        for l in range(s):
+            x0 = segments[l, 0, 0]
+            y0 = segments[l, 0, 1]
+            x1 = segments[l, 1, 0]
+            y1 = segments[l, 1, 1]
+            above = x0 > x or x1 > x
+            below = x0 < x or x1 < x
+            same = x0 == x or x1 == x
+            if not ((above and below) or (same and above)) or x1 == x0:
+                continue
+            crossings[count] = y0 + (x - x0) / (x1 - x0) * (y1 - y0)
+            count += 1
+        crossings = np.sort(crossings[:count])
+        for c in range(0, count - 1, 2):
+            start = max(int(math.ceil(crossings[c])), 0)
+            stop = min(int(math.floor(crossings[c+1])), ny - 1)
+            for y in range(start, stop + 1):
+                pixels[x, y] = True
+
+def _inside_mask(mesh, bounding_box, buffer):
+    index = buildLayerIndex(mesh)
+    shape = (bounding_box[2]+2*buffer, bounding_box[0]+2*buffer, bounding_box[1]+2*buffer)
+    inside = np.zeros(shape, dtype=bool)
+    for height in range(bounding_box[2]):
+        segments = sliceLayer(index, height)
+        layer = inside[height+buffer, buffer:buffer+bounding_box[0], buffer:buffer+bounding_box[1]]
+        _parity_fill(np.ascontiguousarray(segments[:, :, :2], dtype=np.float64), layer)
+    return inside
+
+def meshToSDF(inputFilePath, resolution, buffer):
+    #inputFilePath = STL to convert
+    #resolution, buffer = same meaning as in voxelize
+    #Outputs a float32 signed distance field (in voxels, negative = inside) on the
+    #same padded grid that voxelize returns, plus the model size. The field can go
+    #straight into condense, skipping SDF3D.
+    mesh, modelSize, bounding_box = loadScaledMesh(inputFilePath, resolution)
+    inside = _inside_mask(mesh, bounding_box, buffer)
+    # Grid axes are (layer, x, y), so reorder the triangle coordinates to match.
+    tris = np.asarray(mesh, dtype=np.float64).reshape(-1, 3, 3)[:, :, [2, 0, 1]] + buffer
+    tris = np.ascontiguousarray(tris)
+    shape = inside.shape
+    cell = max(int(SDF_CELL), 1)
+    band = float(cell)
+    cellDims = np.array([(dim + cell - 1)//cell for dim in shape], dtype=np.int64)
+    offsets, ids = _bin_triangles(tris, cellDims, cell, band)
+    dist = np.zeros(shape, dtype=np.float32)
+    nearest = np.empty(shape, dtype=np.int32)
+    _band_distance(tris, offsets, ids, cellDims, cell, band, dist, nearest)
+    far = nearest < 0
+    if far.any() and not far.all():
+        ind = ndimage.distance_transform_edt(far, return_distances=False, return_indices=True)
+        _far_distance(tris, nearest, ind[0], ind[1], ind[2], dist)
+        del ind
+    # SDF3D measures between voxel centres, so a surface halfway between two
+    # voxels reads +-1 there. Offsetting by half a voxel keeps that convention
+    # (shell widths, genRandPoints densities) while preserving sub-voxel detail.
+    dist += 0.5
+    np.negative(dist, out=dist, where=inside)
+    print("Mesh SDF complete!")
+    return dist, modelSize
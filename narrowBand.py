@@ -0,0 +1,172 @@
+import numpy as np
+from quantize import isQuantized
+
+# Narrow-band storage for distance fields. The grid is split into cubic bricks;
+# only bricks that hold a value within `band` of the zero level set (or a sign
+# change) keep their voxels. Every other brick is a single clamped "far" value,
+# so thin-strut lattices cost memory proportional to their surface, not the box.
+
+BRICK = 8
+
+class NarrowBandField:
+    def __init__(self, shape, band, brick, index, bricks, far):
+        #shape = dense grid shape
+        #band = distance kept around the zero level set (in voxels)
+        #brick = brick edge length (in voxels)
+        #index = brick grid of indices into bricks, -1 for far bricks
+        #bricks = (nActive, brick, brick, brick) float32 voxel values
+        #far = brick grid of float32 values used for every voxel of a far brick
+        self.shape = tuple(shape)
+        self.band = float(band)
+        self.brick = int(brick)
+        self.index = index
+        self.bricks = bricks
+        self.far = far
+
+    @property
+    def dtype(self):
+        return self.bricks.dtype
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.bricks.nbytes + self.far.nbytes
+
+    @classmethod
+    def fromDense(cls, u, band, brick=BRICK):
+        #u = dense field, band = distance to keep around the surface
+        u = np.asarray(u, dtype=np.float32)
+        pads = [(0, (-dim) % brick) for dim in u.shape]
+        grid = tuple((dim + pad[1])//brick for dim, pad in zip(u.shape, pads))
+        padded = np.pad(u, pads, mode="edge") if any(pad[1] for pad in pads) else u
+        blocks = padded.reshape(grid[0], brick, grid[1], brick, grid[2], brick).transpose(0, 2, 4, 1, 3, 5)
+        blocks = blocks.reshape(-1, brick, brick, brick)
+        index, bricks, far = _classify(blocks, band)
+        return cls(u.shape, band, brick, index.reshape(grid), bricks, far.reshape(grid))
+
+    def toDense(self):
+        #Outputs the full float32 grid, far bricks filled with their clamped value.
+        b = self.brick
+        grid = self.index.shape
+        blocks = np.empty(grid + (b, b, b), dtype=np.float32)
+        blocks[...] = self.far[..., None, None, None]
+        active = self.index >= 0
+        blocks[active] = self.bricks[self.index[active]]
+        dense = blocks.transpose(0, 3, 1, 4, 2, 5).reshape(grid[0]*b, grid[1]*b, grid[2]*b)
+        return np.ascontiguousarray(dense[:self.shape[0], :self.shape[1], :self.shape[2]])
+
+    def slab(self, start, stop):
+        #Dense float32 copy of the X range [start, stop), clipped to the grid.
+        b = self.brick
+        start, stop = max(start, 0), min(stop, self.shape[0])
+        b0, b1 = start//b, (stop + b - 1)//b
+        sub = NarrowBandField(((b1 - b0)*b,) + self.shape[1:], self.band, b,
+                              self.index[b0:b1], self.bricks, self.far[b0:b1])
+        return sub.toDense()[start - b0*b:stop - b0*b]
+
+    def countInside(self):
+        #Number of voxels with a value <= 0, ignoring brick padding.
+        b = self.brick
+        grid = self.index.shape
+        valid = [np.clip(self.shape[axis] - np.arange(grid[axis])*b, 0, b) for axis in range(3)]
+        voxels = valid[0][:, None, None]*valid[1][None, :, None]*valid[2][None, None, :]
+        active = self.index >= 0
+        count = int(voxels[~active & (self.far <= 0)].sum())
+        ids = np.argwhere(active)
+        r = np.arange(b)
+        inX = r[None, :, None, None] < (self.shape[0] - ids[:, 0]*b)[:, None, None, None]
+        inY = r[None, None, :, None] < (self.shape[1] - ids[:, 1]*b)[:, None, None, None]
+        inZ = r[None, None, None, :] < (self.shape[2] - ids[:, 2]*b)[:, None, None, None]
+        inside = (self.bricks[self.index[active]] <= 0) & inX & inY & inZ
+        return count + int(inside.sum())
+
+def isBand(u):
+    return isinstance(u, NarrowBandField)
+
+def asDense(u):
+    #Dense view of u, whether or not it is a NarrowBandField or QuantizedField.
+    return u.toDense() if isBand(u) or isQuantized(u) else u
+
+def _classify(blocks, band):
+    # A brick stays active when any voxel is inside the band or the brick
+    # straddles the surface; other bricks collapse to +-band.
+    lo = blocks.min(axis=(1, 2, 3))
+    hi = blocks.max(axis=(1, 2, 3))
+    active = (np.abs(blocks) < band).any(axis=(1, 2, 3)) | ((lo <= 0) & (hi > 0))
+    index = np.full(len(blocks), -1, dtype=np.int32)
+    index[active] = np.arange(int(active.sum()), dtype=np.int32)
+    far = np.where(lo > 0, band, -band).astype(np.float32)
+    return index, np.ascontiguousarray(blocks[active], dtype=np.float32), far
+
+def _like(u, ref):
+    if isBand(u):
+        if u.shape != ref.shape or u.brick != ref.brick:
+            raise ValueError("Narrow-band fields must share shape and brick size")
+        return u
+    return NarrowBandField.fromDense(u, ref.band, ref.brick)
+
+def _gather(u, ids):
+    b = u.brick
+    index = u.index.reshape(-1)[ids]
+    out = np.empty((len(ids), b, b, b), dtype=np.float32)
+    out[...] = u.far.reshape(-1)[ids][:, None, None, None]
+    active = index >= 0
+    out[active] = u.bricks[index[active]]
+    return out
+
+def combine(u, v, op):
+    #u,v = fields (at least one NarrowBandField), op = elementwise numpy ufunc
+    #Applies op brick by brick; only bricks active in either operand are touched.
+    ref = u if isBand(u) else v
+    u, v = _like(u, ref), _like(v, ref)
+    band = max(u.band, v.band)
+    ids = np.flatnonzero((u.index >= 0) | (v.index >= 0))
+    blocks = op(_gather(u, ids), _gather(v, ids))
+    far = op(u.far, v.far).astype(np.float32).reshape(-1)
+    sub, bricks, subFar = _classify(blocks, band)
+    index = np.full(far.shape, -1, dtype=np.int32)
+    index[ids] = sub
+    far[ids] = np.where(sub >= 0, far[ids], subFar)
+    return NarrowBandField(u.shape, band, u.brick, index.reshape(u.index.shape), bricks, far.reshape(u.far.shape))
+
+def negate(u):
+    return NarrowBandField(u.shape, u.band, u.brick, u.index, -u.bricks, -u.far)
+
+def offset(u, weight):
+    #Subtracts weight everywhere (thicken), keeping the band layout.
+    return NarrowBandField(u.shape, u.band, u.brick, u.index, u.bricks - np.float32(weight), u.far - np.float32(weight))
+
+def union(u, v):
+    return combine(u, v, np.minimum)
+
+def intersection(u, v):
+    return combine(u, v, np.maximum)
+
+def subtract(u, v):
+    ref = u if isBand(u) else v
+    return combine(negate(_like(u, ref)), v, np.maximum)
+
+def thicken(u, weight):
+    return offset(u, weight)
+
+def shell(u, sT):
+    return intersection(u, offset(negate(u), sT))
+
+def mapSlabs(u, fn, halo, slabBricks=4):
+    #u = NarrowBandField, fn = function of a dense X slab returning a same-shape field
+    #halo = voxels of context fn needs on each side along X
+    #Applies fn slab by slab so only a few brick rows are ever dense, returns a new NarrowBandField.
+    b = u.brick
+    rows = u.index.shape[0]
+    indices, bricks, fars = [], [], []
+    count = 0
+    for b0 in range(0, rows, slabBricks):
+        b1 = min(b0 + slabBricks, rows)
+        start, stop = b0*b, min(b1*b, u.shape[0])
+        lo = max(start - halo, 0)
+        dense = fn(u.slab(lo, stop + halo))
+        part = NarrowBandField.fromDense(dense[start - lo:stop - lo], u.band, b)
+        indices.append(np.where(part.index >= 0, part.index + count, -1))
+        bricks.append(part.bricks)
+        fars.append(part.far)
+        count += len(part.bricks)
+    return NarrowBandField(u.shape, u.band, b, np.concatenate(indices), np.concatenate(bricks), np.concatenate(fars))
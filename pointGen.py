@@ -1,23 +1,24 @@
 from numba import cuda
-from Frep import union
 import numpy as np
 import userInput as u
+from backend import useCuda
 try: TPB = u.TPB 
 except: TPB = 8
-try:
-    CUDA_AVAILABLE = cuda.is_available()
-except Exception:
-    CUDA_AVAILABLE = False
 
 def _gen_rand_points_cpu(u, threshold):
+    #Draws the random numbers one X layer at a time: the same stream as a single
+    #rand(x,y,z) call, without a float64 copy of the whole grid.
     x,y,z = u.shape
     threshold = threshold/max(x,y,z)
-    rand = np.random.rand(x,y,z)
-    denom = np.maximum(np.abs(u), 1e-6)
-    mask = (u < 0) & (rand < (threshold/denom))
     points = np.ones(u.shape, dtype=np.float32)
-    points[mask] = 0
-    print(f"{int(mask.sum())} Points")
+    count = 0
+    for i in range(x):
+        layer = np.asarray(u[i])
+        rand = np.random.rand(y,z)
+        mask = (layer < 0) & (rand < (threshold/np.maximum(np.abs(layer), 1e-6)))
+        points[i][mask] = 0
+        count += int(mask.sum())
+    print(f"{count} Points")
     return points
 
 @cuda.reduce
@@ -38,33 +39,31 @@ def genRandPoints(u,threshold):
     #u = Voxel model of boundary object.
     #threshold = normalized value to determine how likely it is for each voxel to have a point placed in it.
     #Outputs a matrix with random points within the boundaries of object u.  The random points are set to 0 while the rest of the matrix is ones.
-    if not CUDA_AVAILABLE:
+    if not useCuda("genRandPoints", u.size):
         return _gen_rand_points_cpu(u, threshold)
     x,y,z = u.shape
     threshold=threshold/max(x,y,z) 
     TPBX, TPBY, TPBZ = TPB, TPB, TPB
     d_r = cuda.to_device(np.random.rand(x,y,z))
     d_u = cuda.to_device(u)
-    d_v = cuda.to_device(np.ones(u.shape)) #Generates a matrix for us to plot the points in 
+    d_v = cuda.to_device(np.ones(u.shape, dtype=np.float32)) #Generates a matrix for us to plot the points in 
     gridDims = (x+TPBX-1)//TPBX, (y+TPBY-1)//TPBY, (z+TPBZ-1)//TPBZ
     blockDims = TPBX, TPBY, TPBZ
     genRandPointsKernel[gridDims, blockDims](d_u, d_r, d_v, threshold)
     print(str(int((x*y*z-sum_reduce(cuda.to_device(d_v.copy_to_host().flatten())))+0.5))+" Points") #Prints how many random points were generated.
     return d_v.copy_to_host()
 
-def explode(u):
+def explode(u, out=None):
     #u = points, negative = internal
-    m,n,p = u.shape
+    #out = optional float32 array for the result
+    #Outputs the union of the three axis projections of u stretched back over the grid,
+    #minus one half. The projections are broadcast instead of tiled into full grids.
+    if out is None:
+        out = np.empty(u.shape, dtype=np.float32)
     x = u.min(0)
     y = u.min(1)
     z = u.min(2)
-    x_stretch = np.ones(u.shape)
-    y_stretch = np.ones(u.shape)
-    z_stretch = np.ones(u.shape)
-    for i in range(m):
-        x_stretch[i,:,:] = x
-    for j in range(n):
-        y_stretch[:,j,:] = y
-    for k in range(p):
-        z_stretch[:,:,k] = z
-    return union(union(x_stretch,y_stretch),z_stretch)-np.ones(u.shape)/2
+    np.minimum(x[np.newaxis,:,:], y[:,np.newaxis,:], out=out)
+    np.minimum(out, z[:,:,np.newaxis], out=out)
+    out -= 0.5
+    return out
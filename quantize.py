@@ -0,0 +1,64 @@
+import numpy as np
+import userInput as u
+
+# Compact fixed-point storage for distance fields. Values are int16 multiples
+# of `step` voxels, so a grid costs half the memory of float32 and every
+# elementwise pass over it moves half the bytes. Encoding saturates at
+# +-LIMIT steps and never rounds a nonzero value to 0, so the stored sign of
+# every voxel (inside, surface, outside) is exact. Stored distances are within
+# half a step, one step for values within a step of zero. Operations evaluated
+# on quantized leaves see the rounded distances and can flip voxels right at
+# the surface. csg reads and writes these fields inside its fused kernels.
+
+try: FIELD_STEP = u.FIELD_STEP
+except: FIELD_STEP = 1/128
+
+LIMIT = 32767
+
+class QuantizedField:
+    def __init__(self, data, step):
+        #data = int16 grid of distances in units of step
+        #step = voxels per unit of data
+        self.data = data
+        self.step = float(step)
+
+    @classmethod
+    def empty(cls, shape, step=FIELD_STEP):
+        return cls(np.empty(shape, dtype=np.int16), step)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    @property
+    def reach(self):
+        #Largest distance that is stored without saturating (in voxels).
+        return LIMIT*self.step
+
+    def toDense(self):
+        #Outputs the full float32 grid.
+        return np.multiply(self.data, np.float32(self.step), dtype=np.float32)
+
+    def slab(self, start, stop):
+        #Dense float32 copy of the X range [start, stop).
+        return np.multiply(self.data[start:stop], np.float32(self.step), dtype=np.float32)
+
+    def countInside(self):
+        #Number of voxels with a value <= 0, exact since encoding keeps signs.
+        step = max((1 << 24)//max(self.shape[1]*self.shape[2], 1), 1)
+        return sum(int(np.count_nonzero(self.data[i:i+step] <= 0)) for i in range(0, self.shape[0], step))
+
+def isQuantized(u):
+    return isinstance(u, QuantizedField)
+
+def asFloat(u):
+    #Dense float32 view of u, whether or not it is a QuantizedField.
+    return u.toDense() if isQuantized(u) else u
@@ -0,0 +1,148 @@
+from numba import njit, prange
+import numpy as np
+
+# Support regions stored as runs along X for every (Y,Z) column. Supports are
+# vertical columns under overhangs, so a column holds only a handful of
+# [start, stop) intervals; the dense grid is built only where voronize needs it.
+# The support and table sets match the dense projection/translate/boolean
+# construction in main, voxel for voxel.
+
+class SupportColumns:
+    def __init__(self, shape, offsets, starts, stops):
+        #shape = dense grid shape (X, Y, Z), X vertical
+        #offsets = (Y*Z+1) CSR offsets of each column's intervals, column = j*Z+k
+        #starts, stops = int32 interval bounds along X, stop exclusive
+        self.shape = tuple(shape)
+        self.offsets = offsets
+        self.starts = starts
+        self.stops = stops
+
+    def __len__(self):
+        return len(self.starts)
+
+    def count(self):
+        #Number of voxels covered by the intervals.
+        return int((self.stops - self.starts).sum())
+
+    def rasterize(self, inside=-1.0, outside=1.0):
+        #Dense float32 field, inside on the intervals and outside elsewhere.
+        out = np.full(self.shape, outside, dtype=np.float32)
+        _rasterize(self.offsets, self.starts, self.stops, np.float32(inside), out)
+        return out
+
+    def randPoints(self, threshold):
+        #Same distribution as genRandPoints(xHeight(self.rasterize()), threshold):
+        #a voxel becomes a seed with probability threshold/max(shape)/(stop-X),
+        #stop being the top of its interval. Only interval voxels draw numbers.
+        lengths = self.stops - self.starts
+        rand = np.random.rand(int(lengths.sum()))
+        seeds = np.ones(self.shape, dtype=np.float32)
+        count = _place_seeds(self.offsets, self.starts, self.stops, rand,
+                             threshold/max(self.shape), seeds)
+        print(f"{count} Points")
+        return seeds
+
+@njit
+def _column_layers(o, j, k, minX):
+    #Top of the projected column: the highest voxel with o <= 0 at or above minX, 0 if none.
+    for X in range(o.shape[0]-1, minX-1, -1):
+        if o[X,j,k] <= 0:
+            return X
+    return 0
+
+@njit
+def _is_support(o, X, j, k, minX, top):
+    # projection fills [minX, top]; thicken(o,1) removes o < 1; the shifted
+    # intersection also needs the voxel above to be support.
+    return minX <= X and X+1 < top and o[X,j,k] >= 1 and o[X+1,j,k] >= 1
+
+@njit
+def _is_table(o, X, j, k, minX, top):
+    # A voxel at least one clear of the object, whose upper neighbour is outside
+    # the object and with solid three layers above that, inside the projection.
+    m = o.shape[0]
+    return (minX <= X and X < top and o[X,j,k] >= 1 and o[(X+1) % m,j,k] >= 0
+            and o[(X+4) % m,j,k] <= 0)
+
+@njit(parallel=True)
+def _count_runs(o, minX, table, counts):
+    m, n, p = o.shape
+    for c in prange(n*p):
+        j, k = c//p, c % p
+        top = _column_layers(o, j, k, minX)
+        runs = 0
+        prev = False
+        for X in range(m):
+            cur = _is_table(o, X, j, k, minX, top) if table else _is_support(o, X, j, k, minX, top)
+            if cur and not prev:
+                runs += 1
+            prev = cur
+        counts[c+1] = runs
+
+@njit(parallel=True)
+def _fill_runs(o, minX, table, offsets, starts, stops):
+    m, n, p = o.shape
+    for c in prange(n*p):
+        j, k = c//p, c % p
+        top = _column_layers(o, j, k, minX)
+        r = offsets[c]
+        prev = False
+        for X in range(m):
+            cur = _is_table(o, X, j, k, minX, top) if table else _is_support(o, X, j, k, minX, top)
+            if cur and not prev:
+                starts[r] = X
+            elif prev and not cur:
+                stops[r] = X
+                r += 1
+            prev = cur
+        if prev:
+            stops[r] = m
+
+@njit(parallel=True)
+def _rasterize(offsets, starts, stops, inside, out):
+    n, p = out.shape[1], out.shape[2]
+    for c in prange(n*p):
+        j, k = c//p, c % p
+        for r in range(offsets[c], offsets[c+1]):
+            for X in range(starts[r], stops[r]):
+                out[X,j,k] = inside
+
+@njit
+def _place_seeds(offsets, starts, stops, rand, threshold, seeds):
+    p = seeds.shape[2]
+    count = 0
+    d = 0
+    for c in range(len(offsets)-1):
+        j, k = c//p, c % p
+        for r in range(offsets[c], offsets[c+1]):
+            for X in range(starts[r], stops[r]):
+                if rand[d] < threshold/(stops[r]-X):
+                    seeds[X,j,k] = 0
+                    count += 1
+                d += 1
+    return count
+
+def _columns(origShape, table):
+    o = np.ascontiguousarray(origShape, dtype=np.float32)
+    m, n, p = o.shape
+    layers = np.flatnonzero((o < 0).any(axis=(1,2)))
+    minX = int(layers[0]) if layers.size else m
+    counts = np.zeros(n*p+1, dtype=np.int64)
+    _count_runs(o, minX, table, counts)
+    offsets = np.cumsum(counts)
+    starts = np.empty(offsets[-1], dtype=np.int32)
+    stops = np.empty(offsets[-1], dtype=np.int32)
+    _fill_runs(o, minX, table, offsets, starts, stops)
+    return SupportColumns(o.shape, offsets, starts, stops)
+
+def supportColumns(origShape):
+    #origShape = model SDF, negative = inside, X vertical
+    #Outputs the support volume under every overhang as column intervals. Same
+    #voxels as erode(S, [(-1,0,0)]) with
+    #S = subtract(thicken(origShape,1), projection(origShape)).
+    return _columns(origShape, False)
+
+def tableColumns(origShape):
+    #Outputs the thin plate just under each overhang that ties the support to the
+    #part, the "table" built in main from projection and translate.
+    return _columns(origShape, True)
@@ -0,0 +1,201 @@
+import atexit
+import math
+import os
+import shutil
+import tempfile
+import numpy as np
+import Frep as f
+import csg
+import narrowBand as nb
+from SDF3D import SDF3D
+from pointGen import genRandPoints
+from voronize import voronize
+from voxelize import loadScaledMesh, buildLayerIndex, voxelizeLayersParallel
+import userInput as u
+
+# Out-of-core execution for grids that do not fit in RAM. Full-size fields live
+# in memory-mapped .npy files under SPILL_DIR, and every stage runs on X slabs
+# sized from MEMORY_BUDGET_MB. Each slab is widened by a halo so stencils, jump
+# flood and distance transforms see the neighbourhood they need; only the slab
+# core is written back. Distances longer than the halo are clamped to it.
+
+MEMORY_BUDGET_MB = getattr(u, "MEMORY_BUDGET_MB", 0)
+TILE_HALO_VOX = getattr(u, "TILE_HALO_VOX", 0)
+SPILL_DIR = getattr(u, "SPILL_DIR", "")
+BYTES_PER_VOXEL = 96 #Rough peak working set of voronize per slab voxel (jump flood buffers dominate)
+
+_spillDir = None
+
+def _cleanup():
+    if _spillDir is not None:
+        shutil.rmtree(_spillDir, ignore_errors=True)
+
+atexit.register(_cleanup)
+
+def spill(shape, dtype=np.float32, fill=None):
+    #Allocates a memory-mapped array in the spill directory (removed at exit).
+    global _spillDir
+    if _spillDir is None:
+        _spillDir = tempfile.mkdtemp(prefix="voronizer_", dir=SPILL_DIR or None)
+    handle, path = tempfile.mkstemp(suffix=".npy", dir=_spillDir)
+    os.close(handle)
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+    if fill is not None:
+        out[...] = fill
+    return out
+
+def slabThickness(shape, halo, bytesPerVoxel=BYTES_PER_VOXEL, budgetMB=None):
+    #Outputs how many X layers of core fit in the budget once the halo is added.
+    if budgetMB is None:
+        budgetMB = MEMORY_BUDGET_MB
+    plane = shape[1]*shape[2]*bytesPerVoxel
+    layers = int(budgetMB*1024*1024 // max(plane, 1)) - 2*halo
+    if layers < 1:
+        print("Memory budget is smaller than one slab; using single-layer slabs.")
+        layers = 1
+    return min(layers, shape[0])
+
+def tiledMap(fn, *fields, halo=0, bytesPerVoxel=BYTES_PER_VOXEL, out=None):
+    #fn = function of dense X slabs of every field, returning a same-shape slab
+    #fields = same-shape arrays or memmaps
+    #halo = X layers of context fn needs on each side
+    #Outputs a spilled float32 field holding fn applied over the whole grid.
+    shape = fields[0].shape
+    if out is None:
+        out = spill(shape)
+    core = slabThickness(shape, halo, bytesPerVoxel)
+    for start in range(0, shape[0], core):
+        stop = min(start + core, shape[0])
+        lo, hi = max(start - halo, 0), min(stop + halo, shape[0])
+        result = nb.asDense(fn(*[np.asarray(field[lo:hi]) for field in fields]))
+        out[start:stop] = result[start - lo:stop - lo]
+    out.flush()
+    return out
+
+def tiledEvaluate(expr):
+    #Evaluates a csg expression (primitives, booleans) slab by slab into a spilled
+    #field; primitives are computed from their axis vectors, never a full meshgrid.
+    out = spill(expr.shape)
+    core = slabThickness(expr.shape, 0, bytesPerVoxel=4)
+    for start in range(0, expr.shape[0], core):
+        stop = min(start + core, expr.shape[0])
+        csg.evaluate(csg.slab(expr, start, stop), out=np.asarray(out[start:stop]))
+    out.flush()
+    return out
+
+def tiledVoxelize(inputFilePath, resolution, buffer):
+    #Same contract as voxelize, but the occupancy grid and the ±0.01 field are
+    #written straight into spilled memmaps.
+    mesh, modelSize, bounding_box = loadScaledMesh(inputFilePath, resolution)
+    vol = spill((bounding_box[2], bounding_box[0], bounding_box[1]), dtype=bool, fill=False)
+    voxelizeLayersParallel(buildLayerIndex(mesh), vol, max(os.cpu_count() or 1, 1))
+    out = spill((vol.shape[0]+2*buffer, vol.shape[1]+2*buffer, vol.shape[2]+2*buffer), fill=0.01)
+    core = slabThickness(vol.shape, 0, bytesPerVoxel=5)
+    for start in range(0, vol.shape[0], core):
+        stop = min(start + core, vol.shape[0])
+        out[buffer+start:buffer+stop, buffer:buffer+vol.shape[1], buffer:buffer+vol.shape[2]] = \
+            np.where(vol[start:stop], np.float32(-0.01), np.float32(0.01))
+    out.flush()
+    print("Voxelize complete!")
+    return out, modelSize
+
+def tiledCondense(u, buffer):
+    #condense for memmapped fields: finds the occupied box slab by slab, then
+    #copies it out, padding with the background value where the box leaves the grid.
+    lo = np.array(u.shape)
+    hi = np.full(3, -1)
+    background = -np.inf
+    core = slabThickness(u.shape, 0, bytesPerVoxel=5)
+    for start in range(0, u.shape[0], core):
+        slab = np.asarray(u[start:start+core])
+        background = max(background, float(slab.max()))
+        coords = np.argwhere(slab < 0)
+        if coords.size:
+            coords[:, 0] += start
+            lo = np.minimum(lo, coords.min(axis=0))
+            hi = np.maximum(hi, coords.max(axis=0))
+    if (hi < 0).any():
+        return u
+    if background <= 0:
+        background = 0.01
+    lo = lo - buffer
+    hi = hi + buffer + 1
+    out = spill(hi - lo, fill=background)
+    src = [slice(max(lo[axis], 0), min(hi[axis], u.shape[axis])) for axis in range(3)]
+    dst = [slice(s.start - lo[axis], s.stop - lo[axis]) for axis, s in enumerate(src)]
+    core = slabThickness(out.shape, 0, bytesPerVoxel=8)
+    for start in range(src[0].start, src[0].stop, core):
+        stop = min(start + core, src[0].stop)
+        out[start-lo[0]:stop-lo[0], dst[1], dst[2]] = u[start:stop, src[1], src[2]]
+    out.flush()
+    return out
+
+def sdfHalo():
+    return max(TILE_HALO_VOX, 16)
+
+def tiledSDF3D(u, halo=None):
+    #SDF3D over slabs; values are exact up to the halo and clamped to ±halo beyond it.
+    if halo is None:
+        halo = sdfHalo()
+    return tiledMap(lambda s: np.clip(SDF3D(s), -halo, halo), u, halo=halo, bytesPerVoxel=32)
+
+def coarseSDF(u, bytesPerVoxel=32):
+    #Unclamped SDF3D of u sampled every k voxels, k the smallest step whose grid
+    #fits the budget. Outputs k and the coarse field (in full-grid voxels), or
+    #None when the samples miss the inside entirely.
+    k = 1
+    if MEMORY_BUDGET_MB > 0:
+        k = max(int(math.ceil((u.size*bytesPerVoxel/(MEMORY_BUDGET_MB*1024*1024))**(1/3))), 1)
+    core = slabThickness(u.shape, 0, bytesPerVoxel=4)*k
+    coarse = np.concatenate([np.asarray(u[start:start+core:k, ::k, ::k])
+                             for start in range(0, u.shape[0], core)])
+    if not (coarse < 0).any():
+        return k, None
+    return k, SDF3D(coarse)*np.float32(k)
+
+def tiledRandPoints(u, threshold, halo=None):
+    #genRandPoints over slabs, with the density normalised to the full grid.
+    #u = tiledSDF3D output, halo = its clamp
+    #Seeds are placed with probability threshold/|u|, so every voxel deeper than
+    #the clamp would be seeded as if it sat at the halo. Those voxels read their
+    #depth from coarseSDF instead, within about k voxels of the exact value.
+    if halo is None:
+        halo = sdfHalo()
+    full = max(u.shape)
+    k, coarse = coarseSDF(u)
+    out = spill(u.shape)
+    core = slabThickness(u.shape, 0, bytesPerVoxel=24)
+    for start in range(0, u.shape[0], core):
+        stop = min(start + core, u.shape[0])
+        slab = np.array(u[start:stop])
+        if coarse is not None:
+            i, j, l = np.nonzero(slab <= -halo)
+            slab[i, j, l] = np.minimum(coarse[(i + start)//k, j//k, l//k], -halo)
+        out[start:stop] = genRandPoints(slab, threshold*max(slab.shape)/full)
+    out.flush()
+    return out
+
+def tiledSmooth(u, iteration=1):
+    #smooth over slabs, with the halo smooth itself reports it needs.
+    return tiledMap(lambda s: f.smooth(s, iteration), u, halo=f.smoothReach(iteration), bytesPerVoxel=16)
+
+def seedHalo(seedPoints, cellThickness):
+    #Halo wide enough for every voxel to see the seeds of its neighbouring cells:
+    #two mean seed spacings plus the strut radius, unless TILE_HALO_VOX overrides it.
+    if TILE_HALO_VOX > 0:
+        return int(TILE_HALO_VOX)
+    seeds = 0
+    core = slabThickness(seedPoints.shape, 0, bytesPerVoxel=5)
+    for start in range(0, seedPoints.shape[0], core):
+        seeds += int(np.count_nonzero(np.asarray(seedPoints[start:start+core]) <= 0))
+    spacing = (seedPoints.size / max(seeds, 1)) ** (1/3)
+    return int(math.ceil(2*spacing + cellThickness/2.0 + 2))
+
+def tiledVoronize(origObject, seedPoints, cellThickness, shellThickness, scale, name="Model"):
+    #voronize over overlapping X slabs, stitched into a spilled field.
+    halo = seedHalo(seedPoints, cellThickness)
+    print("Tiled voronize with a halo of "+str(halo)+" voxels")
+    out = tiledMap(lambda o, s: voronize(o, s, cellThickness, shellThickness, scale),
+                   origObject, seedPoints, halo=halo)
+    print("Voronize for " + name + " Complete!")
+    return out
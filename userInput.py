@@ -3,15 +3,36 @@ MODEL = True        #Generates model with infill
 SUPPORT = False      #Generates support structure
 SEPARATE_SUPPORTS = True #Spits out two files, one for the support and one for the object
 PERFORATE = False    #Perforates the support structure to allow fluids into the support cells
+SUPPORT_COLUMNS = True   #Builds supports and their seeds from per-column X intervals instead of full 3D boolean passes
 IMG_STACK = False   #Outputs an image stack of the model
 AESTHETIC = False   #Removes all internal detail, works best with INVERSE
 INVERSE = False     #Also includes the inverse of the model as a separate file
 NET = True          #Only draws voronoi patterns at the surface of the objec
 NET_CONNECT = True  #When NET is True, also fuse in the volumetric Voronoi interior
 SMOOTH = True       #Smooths the output meshes, removes the voxelized texture
+SMOOTH_BAND = True  #Smooths only the band around the surface with separable passes (same mesh, less work)
 NET_THICKNESS_MM = 1.0   #Sets the thickness of the net in millimeters (normalized to resolution)
 BUFFER_MM = 1.0          #Sets the empty margin around the object in millimeters
 TPB = 8             #Threads per block, leave at 8 unless futzing.
+BACKEND = "auto"    #Kernel backend: "auto" (CUDA only above the calibrated grid size per operation), "cpu" or "cuda"
+BACKEND_OVERRIDES = {}   #Per-operation backend, e.g. {"smooth": "cpu"}; names as in benchmark.CALIBRATION_OPS
+VOXELIZER = "scanline"   #Voxelization engine: "scanline" (compiled parity fill) or "legacy" (original per-pixel loop)
+DIRECT_SDF = False       #Builds the model SDF straight from the STL triangles instead of voxelizing + SDF3D
+SDF_CELL = 4             #Triangle bucket size (voxels) for DIRECT_SDF; distances within this band are exact
+NARROW_BAND_VOX = 0      #Stores strut fields only within this many voxels of their surface (0 = dense grids)
+FIELD_DTYPE = "float32"  #Storage of finished strut fields: "float32" or "int16" (fixed point, half the memory)
+FIELD_STEP = 1/128       #Voxels per int16 step; distances beyond 32767 steps saturate
+VOXEL_CACHE = True       #Reuses condensed model SDFs from the Cache folder when the STL and grid settings match
+CACHE_MAX_MB = 2048      #Size limit of the Cache folder, least recently used entries are deleted first
+VOXELIZE_WORKERS = 0     #Threads used to voxelize layers with the scanline engine (0 = one per CPU core, 1 = serial)
+MEMORY_BUDGET_MB = 0     #Runs imported models and primitives out-of-core in X slabs that fit this budget (0 = whole grids in RAM)
+TILE_HALO_VOX = 0        #Overlap between slabs in voxels (0 = sized from the seed spacing and strut radius)
+SPILL_DIR = ""           #Folder for the memory-mapped intermediate grids ("" = system temp folder)
+JF_CPU_ENGINE = "auto"   #CPU jump flood: "auto" (EDT for Euclidean, compiled jump flood otherwise), "edt" or "jfa"
+JF_LABELS = True         #Voronoi cells propagate int32 seed labels instead of (X,Y,Z,4) coordinate grids
+VORONOI_ENGINE = "grid"  #Strut field for voronize: "grid" (jump flood + strutFinder + SDF3D) or "kdtree" (exact 3-nearest-seed edges)
+VORONOI_MASK = True      #voronize only evaluates bricks within the strut radius of the part
+VORONOI_COARSE = 0       #Coarse-to-fine voronize: labels cells on a grid this many times coarser and refines only near struts (0 = off, 4 works well)
 SHOW_PLOTS = False   #Disable matplotlib slice/contour plots (useful for batch runs)
 AUTO_EXPORT = True   #Skip the interactive export prompt and always write meshes
 RUN_LABEL = ""       #Optional label appended to output filenames for sweeps
@@ -1,9 +1,16 @@
 from collections import deque
+import math
 from visualizeSlice import slicePlot, contourPlot
 import Frep as f
-from SDF3D import SDF3D, jumpFlood
+import csg
+import narrowBand as nb
+from bufferPool import pool
+from backend import useCuda
+from SDF3D import jumpFlood, jumpFloodLabels, seedDistance, _lp_distance
 from numba import cuda, njit, prange
 import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
 import userInput as u
 try: TPB = u.TPB 
 except: TPB = 8
@@ -12,17 +19,36 @@ try:
 except Exception:
     SHOW_PLOTS = True
 try:
-    CUDA_AVAILABLE = cuda.is_available()
+    NARROW_BAND_VOX = u.NARROW_BAND_VOX
 except Exception:
-    CUDA_AVAILABLE = False
+    NARROW_BAND_VOX = 0
+try:
+    JF_LABELS = u.JF_LABELS
+except Exception:
+    JF_LABELS = True
+try:
+    VORONOI_ENGINE = u.VORONOI_ENGINE
+except Exception:
+    VORONOI_ENGINE = "grid"
+try:
+    VORONOI_MASK = u.VORONOI_MASK
+except Exception:
+    VORONOI_MASK = True
+try:
+    VORONOI_COARSE = u.VORONOI_COARSE
+except Exception:
+    VORONOI_COARSE = 0
+KD_BATCH = 1 << 16 #Voxels per cKDTree query batch, bounds the float64 temporaries (~20 MB)
+STRUT_MARGIN = 2.0 #Voxels of exact distance kept past the strut surface (smoothing, narrow bands)
 
 @njit(parallel=True)
-def _strut_finder_cpu(points):
+def _strut_finder_cpu(points, active, out):
     x, y, z, _ = points.shape
-    out = np.ones((x, y, z), dtype=np.float32)
     for i in prange(x):
         for j in range(y):
             for k in range(z):
+                if not active[i, j, k]:
+                    continue
                 m0 = points[i, j, k, 0]
                 n0 = points[i, j, k, 1]
                 p0 = points[i, j, k, 2]
@@ -63,13 +89,217 @@ def _strut_finder_cpu(points):
                     out[i, j, k] = -1.0
     return out
 
+@njit(parallel=True)
+def _strut_finder_labels_cpu(labels, active, out):
+    #Same test as _strut_finder_cpu, on int32 seed labels instead of seed coordinates.
+    #Voxels outside active, and unlabelled (-1) neighbours, are skipped.
+    x, y, z = labels.shape
+    for i in prange(x):
+        for j in range(y):
+            for k in range(z):
+                if not active[i, j, k]:
+                    continue
+                first = labels[i, j, k]
+                second = first
+                third = first
+                unique = 1
+                for di in range(-1, 2):
+                    ii = i + di
+                    if ii < 0 or ii >= x:
+                        continue
+                    for dj in range(-1, 2):
+                        jj = j + dj
+                        if jj < 0 or jj >= y:
+                            continue
+                        for dk in range(-1, 2):
+                            kk = k + dk
+                            if kk < 0 or kk >= z:
+                                continue
+                            label = labels[ii, jj, kk]
+                            if label >= 0 and label != first:
+                                if unique == 1:
+                                    second = label
+                                    unique = 2
+                                elif label != second:
+                                    if unique == 2:
+                                        third = label
+                                        unique = 3
+                                    elif label != third:
+                                        unique = 4
+                                        break
+                        if unique >= 4:
+                            break
+                    if unique >= 4:
+                        break
+                if unique >= 3:
+                    out[i, j, k] = -1.0
+    return out
+
+def _edge_distance(x, a, b, c):
+    #Distance from points x to the line where the bisector planes of seeds a, b
+    #and c meet (the Voronoi edge shared by their three cells). The line runs
+    #through the circumcentre of abc along the normal of its plane.
+    ab, ac = b - a, c - a
+    normal = np.cross(ab, ac)
+    nn = np.einsum('ij,ij->i', normal, normal)
+    valid = nn > 1e-9
+    safe = np.where(valid, nn, 1.0)[:, None]
+    centre = a + (np.cross(normal, ab)*np.einsum('ij,ij->i', ac, ac)[:, None]
+                  + np.cross(ac, normal)*np.einsum('ij,ij->i', ab, ab)[:, None])/(2*safe)
+    dist = np.linalg.norm(np.cross(x - centre, normal), axis=1)/np.sqrt(safe[:, 0])
+    # Collinear seeds share no edge, so those voxels are treated as far from any strut.
+    return np.where(valid, dist, 1000.0)
+
+def kdStrutDistance(seedPoints, active=None):
+    #seedPoints = seed grid, 0 at each seed
+    #active = optional boolean mask of the voxels to evaluate, the rest read as far (1000)
+    #Outputs the distance (in voxels) from every voxel to the Voronoi edge of its
+    #three nearest seeds, minus sqrt(3). strutFinder marks every voxel whose 3x3x3
+    #neighbourhood touches three cells, i.e. voxels up to sqrt(3) from an edge,
+    #so the offset keeps strut widths in line with SDF3D(strutFinder(...)).
+    #Coordinates are built per X slab of about KD_BATCH voxels, so the working
+    #set besides out is bounded by the batch rather than the grid.
+    seeds = np.argwhere(np.asarray(seedPoints) <= 0).astype(np.float64)
+    tree = cKDTree(seeds)
+    out = np.full(seedPoints.shape, 1000.0, dtype=np.float32)
+    m, n, p = out.shape
+    rows = max(KD_BATCH//(n*p), 1)
+    for x0 in range(0, m, rows):
+        x1 = min(x0 + rows, m)
+        if active is None:
+            coords = np.indices((x1 - x0, n, p)).reshape(3, -1).T
+        else:
+            coords = np.argwhere(active[x0:x1])
+        coords[:, 0] += x0
+        for start in range(0, len(coords), KD_BATCH):
+            chunk = coords[start:start+KD_BATCH]
+            pts = chunk.astype(np.float64)
+            _, idx = tree.query(pts, k=3, workers=-1)
+            dist = _edge_distance(pts, seeds[idx[:, 0]], seeds[idx[:, 1]], seeds[idx[:, 2]])
+            out[chunk[:, 0], chunk[:, 1], chunk[:, 2]] = dist - np.sqrt(3)
+    return out
+
+@njit(parallel=True)
+def _refine_labels(coarse, refine, seeds, factor, order, labels):
+    #For every full-resolution voxel of a refined coarse cell, picks the nearest
+    #seed among the coarse labels of that cell and its 26 neighbours.
+    cx, cy, cz = coarse.shape
+    m, n, p = labels.shape
+    for a in prange(cx):
+        cand = np.empty(27, dtype=np.int32)
+        for b in range(cy):
+            for c in range(cz):
+                if not refine[a, b, c]:
+                    continue
+                count = 0
+                for na in range(max(a-1, 0), min(a+2, cx)):
+                    for nb_ in range(max(b-1, 0), min(b+2, cy)):
+                        for nc in range(max(c-1, 0), min(c+2, cz)):
+                            label = coarse[na, nb_, nc]
+                            seen = False
+                            for t in range(count):
+                                if cand[t] == label:
+                                    seen = True
+                                    break
+                            if not seen:
+                                cand[count] = label
+                                count += 1
+                for i in range(a*factor, min((a+1)*factor, m)):
+                    for j in range(b*factor, min((b+1)*factor, n)):
+                        for k in range(c*factor, min((c+1)*factor, p)):
+                            best = cand[0]
+                            d = _lp_distance(i, j, k, seeds[best], order)
+                            for t in range(1, count):
+                                d1 = _lp_distance(i, j, k, seeds[cand[t]], order)
+                                if d1 < d:
+                                    best, d = cand[t], d1
+                            labels[i, j, k] = best
+
+def coarseToFineLabels(seedPoints, order, factor, active=None):
+    #seedPoints = seed grid, 0 at each seed
+    #factor = coarse voxel edge length in full-resolution voxels
+    #active = optional boolean mask, as for jumpFloodLabels
+    #Labels the cell centres of a grid coarsened by factor with their exact
+    #nearest seed, finds the coarse struts, and relabels at full resolution only
+    #the coarse cells around them. Outputs (labels, seeds, refined) with labels
+    #-1 outside the full-resolution voxel mask refined.
+    seeds = np.argwhere(np.asarray(seedPoints) <= 0).astype(np.int32)
+    dims = seedPoints.shape
+    cdims = tuple((dim + factor - 1)//factor for dim in dims)
+    centres = np.indices(cdims).reshape(3, -1).T*factor + (factor - 1)/2.0
+    _, idx = cKDTree(seeds).query(centres, k=1, p=order, workers=-1)
+    coarse = idx.astype(np.int32).reshape(cdims)
+    refine = ndimage.binary_dilation(strutFinder(coarse) <= 0, structure=np.ones((3, 3, 3), dtype=bool))
+    if active is not None:
+        #A coarse cell is active when any of its voxels is; cells can straddle bricks.
+        pads = [(0, cdim*factor - dim) for cdim, dim in zip(cdims, dims)]
+        cells = np.pad(active, pads).reshape(cdims[0], factor, cdims[1], factor, cdims[2], factor)
+        refine &= cells.any(axis=(1, 3, 5))
+    labels = np.full(dims, -1, dtype=np.int32)
+    _refine_labels(coarse, refine, seeds, factor, float(order), labels)
+    refined = refine.repeat(factor, 0).repeat(factor, 1).repeat(factor, 2)[:dims[0], :dims[1], :dims[2]]
+    print(f"Refined {refine.mean()*100:.1f}% of the coarse grid")
+    return labels, seeds, np.ascontiguousarray(refined)
+
+def activeMask(origObject, pad, brick=nb.BRICK):
+    #origObject = model SDF, negative = inside
+    #pad = distance (in voxels) around the model that still needs struts
+    #Outputs a boolean voxel mask of every brick holding a voxel within pad of the model.
+    u = nb.asDense(origObject)
+    pads = [(0, (-dim) % brick) for dim in u.shape]
+    near = np.pad(u <= pad, pads)
+    grid = tuple(dim//brick for dim in near.shape)
+    bricks = near.reshape(grid[0], brick, grid[1], brick, grid[2], brick).any(axis=(1, 3, 5))
+    mask = bricks.repeat(brick, 0).repeat(brick, 1).repeat(brick, 2)
+    return np.ascontiguousarray(mask[:u.shape[0], :u.shape[1], :u.shape[2]])
+
+@njit(parallel=True)
+def _strut_distance_cpu(coords, offsets, reach, out):
+    #coords = strut voxel coordinates sorted by X, offsets = CSR start of each X plane
+    #Each thread owns one output plane and stamps the strut voxels within reach of it,
+    #so no two threads write the same voxel.
+    m, n, p = out.shape
+    r = int(np.ceil(reach))
+    reach2 = reach*reach
+    for i in prange(m):
+        plane = out[i]
+        plane[:, :] = reach2
+        for si in range(max(i - r, 0), min(i + r + 1, m)):
+            di2 = (i - si)*(i - si)
+            for s in range(offsets[si], offsets[si+1]):
+                sj, sk = coords[s, 1], coords[s, 2]
+                for j in range(max(sj - r, 0), min(sj + r + 1, n)):
+                    dij2 = di2 + (j - sj)*(j - sj)
+                    if dij2 > reach2:
+                        continue
+                    for k in range(max(sk - r, 0), min(sk + r + 1, p)):
+                        d2 = dij2 + (k - sk)*(k - sk)
+                        if d2 < plane[j, k]:
+                            plane[j, k] = d2
+        for j in range(n):
+            for k in range(p):
+                if plane[j, k] == 0:
+                    plane[j, k] = -1.0
+                else:
+                    plane[j, k] = np.sqrt(plane[j, k])
+
+def toBand(strutSDF, strutRadius):
+    #Switches a strut SDF to narrow-band storage when NARROW_BAND_VOX is set. The
+    #band always reaches at least two voxels past the strut surface so thicken
+    #and the boolean ops that follow stay exact near the zero level set.
+    if NARROW_BAND_VOX <= 0 or nb.isBand(strutSDF):
+        return strutSDF
+    return nb.NarrowBandField.fromDense(strutSDF, max(NARROW_BAND_VOX, strutRadius + 2.0))
+
 def voronize(origObject, seedPoints, cellThickness, shellThickness, scale,
              name = "", sliceLocation = 0, sliceAxis = "X", order = 2):
-    #origObject = voxel model of original object, negative = inside
+    #origObject = voxel model of original object, negative = inside, or a csg
+    #expression (e.g. a primitive scene), evaluated once here
     #seedPoints = same-size matrix with 0s at the location of each seed point, 1s elsewhere
     #cellThickness = approximate strut diameter (in voxels) for the open Voronoi lattice.
     #shellThickness = desired minimum thickness of shell (mm), 0 if no shell
     #name = If given a value, the name of the model, activates progress plots.
+    origObject = csg.evaluate(origObject)
     resX, resY, resZ = origObject.shape
     if sliceLocation == 0:
         if sliceAxis == "X" or sliceAxis == "x":
@@ -78,22 +308,43 @@ def voronize(origObject, seedPoints, cellThickness, shellThickness, scale,
             sliceLocation = resY//2
         else:
             sliceLocation = resZ//2
-    seedPoints = jumpFlood(seedPoints,order)
-    if SHOW_PLOTS and name !="":
-        contourPlot(seedPoints[:,:,:,3],sliceLocation,titlestring="SDF of the Points for "+name,axis = sliceAxis)
-    voronoi = strutFinder(seedPoints)
-    voronoi = SDF3D(voronoi)
-    if SHOW_PLOTS and name !="":
-        slicePlot(voronoi,sliceLocation,titlestring="Voronoi Structure for "+name,axis = sliceAxis)
     strutRadius = max(cellThickness/2.0, 0.0)
-    voronoi = f.intersection(f.thicken(voronoi,strutRadius),origObject)
+    # Only bricks near the part can end up in the trimmed lattice.
+    active = activeMask(origObject, strutRadius + STRUT_MARGIN + 1) if VORONOI_MASK else None
+    nSeeds = np.count_nonzero(seedPoints <= 0)
+    useKD = VORONOI_ENGINE == "kdtree" and order == 2 and nSeeds >= 3
+    if useKD:
+        voronoi = kdStrutDistance(seedPoints, active)
+    elif VORONOI_COARSE > 1 and nSeeds > 0:
+        labels, seeds, refined = coarseToFineLabels(seedPoints, order, int(VORONOI_COARSE), active)
+        if SHOW_PLOTS and name !="":
+            contourPlot(seedDistance(labels,seeds,order),sliceLocation,titlestring="SDF of the Points for "+name,axis = sliceAxis)
+        voronoi = strutFinder(labels, refined, out=pool.take(labels.shape))
+    elif JF_LABELS:
+        labels, seeds = jumpFloodLabels(seedPoints,order,active)
+        if SHOW_PLOTS and name !="":
+            contourPlot(seedDistance(labels,seeds,order),sliceLocation,titlestring="SDF of the Points for "+name,axis = sliceAxis)
+        voronoi = strutFinder(labels, active, out=pool.take(labels.shape))
+    else:
+        seedPoints = jumpFlood(seedPoints,order)
+        if SHOW_PLOTS and name !="":
+            contourPlot(seedPoints[:,:,:,3],sliceLocation,titlestring="SDF of the Points for "+name,axis = sliceAxis)
+        voronoi = strutFinder(seedPoints, active)
+    if not useKD:
+        struts = voronoi
+        voronoi = strutField(struts, strutRadius)
+        pool.give(struts)
+    if SHOW_PLOTS and name !="":
+        slicePlot(nb.asDense(voronoi),sliceLocation,titlestring="Voronoi Structure for "+name,axis = sliceAxis)
+    voronoi = toBand(voronoi, strutRadius)
+    # Dense strut fields are trimmed in place; band fields build their own bricks.
+    voronoi = csg.intersection(csg.thicken(voronoi,strutRadius),origObject).evaluate(out=voronoi)
     if SHOW_PLOTS and name !="":
-        slicePlot(voronoi, sliceLocation, titlestring=(name+' Trimmed and Thinned'),axis = sliceAxis)
+        slicePlot(nb.asDense(voronoi), sliceLocation, titlestring=(name+' Trimmed and Thinned'),axis = sliceAxis)
     if shellThickness>0:
-        u_shell = f.shell(origObject,shellThickness)
-        voronoi = f.union(u_shell,voronoi)
+        voronoi = csg.union(csg.shell(origObject,shellThickness),voronoi).evaluate(out=voronoi)
         if SHOW_PLOTS and name !="":
-            slicePlot(voronoi, sliceLocation, titlestring=name+' With Shell',axis = sliceAxis)
+            slicePlot(nb.asDense(voronoi), sliceLocation, titlestring=name+' With Shell',axis = sliceAxis)
     if name =="":
         name = "Model"
     print("Voronize for " + name + " Complete!")
@@ -106,8 +357,10 @@ def surface_voronoi_net(orig_sdf, seed_density, net_thickness, cell_thickness, s
     surface_mask = shell_sdf <= 0
     surface_band = np.abs(orig_sdf) <= max(1.0, net_thickness * 0.75)
     prob = seed_density / max(orig_sdf.shape)
-    rng = np.random.rand(*orig_sdf.shape)
-    seed_mask = surface_band & (rng < prob)
+    # One X layer of random numbers at a time, same stream as rand(*shape).
+    seed_mask = np.empty(orig_sdf.shape, dtype=bool)
+    for i in range(orig_sdf.shape[0]):
+        seed_mask[i] = surface_band[i] & (np.random.rand(*orig_sdf.shape[1:]) < prob)
     if not seed_mask.any():
         candidates = np.argwhere(surface_band)
         if candidates.size == 0:
@@ -152,22 +405,27 @@ def surface_voronoi_net(orig_sdf, seed_density, net_thickness, cell_thickness, s
         mismatch = (labels[src] != -1) & (labels[dst] != -1) & (labels[src] != labels[dst])
         boundary[src] |= overlap & mismatch
         boundary[dst] |= overlap & mismatch
-    strut_field = np.where(boundary, -1.0, 1.0).astype(np.float32)
-    strut_field = SDF3D(strut_field)
+    struts = pool.take(boundary.shape)
+    struts.fill(1)
+    struts[boundary] = -1
+    del boundary, labels, dist
     radius = max(cell_thickness/2.0, 0.0)
-    surface_net = f.intersection(f.thicken(strut_field, radius), shell_sdf)
+    strut_field = strutField(struts, radius)
+    pool.give(struts)
+    surface_net = csg.intersection(csg.thicken(strut_field, radius), shell_sdf).evaluate(out=shell_sdf)
+    pool.give(strut_field)
     if SHOW_PLOTS and name:
         slice_axis = "X"
         slice_loc = surface_net.shape[0] // 2
-        slicePlot(surface_net, slice_loc, titlestring=f"Surface Voronoi Net for {name}", axis=slice_axis)
+        slicePlot(nb.asDense(surface_net), slice_loc, titlestring=f"Surface Voronoi Net for {name}", axis=slice_axis)
     print("Surface Voronoi net complete!")
     return surface_net
 
 @cuda.jit
-def strutFinderKernel(d_points,d_struts):
+def strutFinderKernel(d_points,d_struts,d_active):
     i,j,k = cuda.grid(3)
     dims = d_struts.shape
-    if i>=dims[0] or j>=dims[1] or k>=dims[2]:
+    if i>=dims[0] or j>=dims[1] or k>=dims[2] or not d_active[i,j,k]:
         return
     m0,n0,p0,_ = d_points[i,j,k]
     second_m, second_n, second_p = m0, n0, p0
@@ -192,20 +450,194 @@ def strutFinderKernel(d_points,d_struts):
                         break
     if unique_count >= 3:
         d_struts[i,j,k] = -1
+
+@cuda.jit
+def strutFinderLabelKernel(d_labels,d_struts,d_active):
+    i,j,k = cuda.grid(3)
+    dims = d_struts.shape
+    if i>=dims[0] or j>=dims[1] or k>=dims[2] or not d_active[i,j,k]:
+        return
+    first = d_labels[i,j,k]
+    second = first
+    third = first
+    unique_count = 1
+    for index in range(27):
+        check_i = i + ((index//9)%3 - 1)
+        check_j = j + ((index//3)%3 - 1)
+        check_k = k + (index%3 - 1)
+        if 0 <= check_i < dims[0] and 0 <= check_j < dims[1] and 0 <= check_k < dims[2]:
+            label = d_labels[check_i,check_j,check_k]
+            if label>=0 and label!=first:
+                if unique_count == 1:
+                    second = label
+                    unique_count = 2
+                elif label!=second:
+                    if unique_count == 2:
+                        third = label
+                        unique_count = 3
+                    elif label!=third:
+                        unique_count = 4
+                        break
+    if unique_count >= 3:
+        d_struts[i,j,k] = -1
         
-def strutFinder(voxel):
-    #voxel = jump-flood output with nearest-seed metadata per voxel
+def strutFinder(voxel, active=None, out=None):
+    #voxel = jump-flood output with nearest-seed metadata per voxel, or the
+    #int32 label grid from jumpFloodLabels
+    #active = optional boolean mask; voxels outside it are never struts
+    #out = optional float32 array for the result
     #Outputs a voxel model with negative voxels along Voronoi edges/vertices to seed struts.
-    if not CUDA_AVAILABLE:
-        return _strut_finder_cpu(voxel)
+    labelled = voxel.ndim == 3
+    if active is None:
+        active = np.ones(voxel.shape[:3], dtype=bool)
+    if out is None:
+        out = np.empty(voxel.shape[:3], dtype=np.float32)
+    out.fill(1)
+    if not useCuda("strutFinder", out.size):
+        if labelled:
+            _strut_finder_labels_cpu(voxel, active, out)
+        else:
+            _strut_finder_cpu(voxel, active, out)
+        return out
     dims = voxel.shape
     d_points = cuda.to_device(voxel)
-    d_struts = cuda.to_device(np.ones(dims[:3]))
+    d_struts = cuda.to_device(out)
+    gridSize = (
+        (dims[0] + TPB - 1) // TPB,
+        (dims[1] + TPB - 1) // TPB,
+        (dims[2] + TPB - 1) // TPB,
+    )
+    blockSize = (TPB, TPB, TPB)
+    d_active = cuda.to_device(active)
+    if labelled:
+        strutFinderLabelKernel[gridSize, blockSize](d_points,d_struts,d_active)
+    else:
+        strutFinderKernel[gridSize, blockSize](d_points,d_struts,d_active)
+    d_struts.copy_to_host(out)
+    return out
+
+@cuda.jit
+def strutDistanceKernel(d_struts,d_out,r,reach2):
+    i,j,k = cuda.grid(3)
+    dims = d_out.shape
+    if i>=dims[0] or j>=dims[1] or k>=dims[2]:
+        return
+    if d_struts[i,j,k]<=0:
+        d_out[i,j,k] = -1
+        return
+    best = reach2
+    for si in range(max(i-r,0),min(i+r+1,dims[0])):
+        for sj in range(max(j-r,0),min(j+r+1,dims[1])):
+            for sk in range(max(k-r,0),min(k+r+1,dims[2])):
+                if d_struts[si,sj,sk]<=0:
+                    d2 = (i-si)*(i-si)+(j-sj)*(j-sj)+(k-sk)*(k-sk)
+                    if d2<best:
+                        best = d2
+    d_out[i,j,k] = math.sqrt(best)
+
+@njit(parallel=True)
+def _strut_band_cpu(coords, offsets, ids, grid, reach, out):
+    #coords = strut voxel coordinates sorted by brick, offsets = CSR start of each brick
+    #ids = linear indices of the bricks to fill, out = (len(ids), brick, brick, brick)
+    #Each thread owns one output brick and stamps the strut voxels of the bricks
+    #around it, so no two threads write the same voxel.
+    b = out.shape[1]
+    r = int(np.ceil(reach))
+    R = (r + b - 1)//b
+    reach2 = reach*reach
+    for t in prange(len(ids)):
+        block = out[t]
+        block[:, :, :] = reach2
+        bi = ids[t]//(grid[1]*grid[2])
+        bj = (ids[t]//grid[2]) % grid[1]
+        bk = ids[t] % grid[2]
+        for ni in range(max(bi - R, 0), min(bi + R + 1, grid[0])):
+            for nj in range(max(bj - R, 0), min(bj + R + 1, grid[1])):
+                for nk in range(max(bk - R, 0), min(bk + R + 1, grid[2])):
+                    nid = (ni*grid[1] + nj)*grid[2] + nk
+                    for s in range(offsets[nid], offsets[nid+1]):
+                        si, sj, sk = coords[s, 0] - bi*b, coords[s, 1] - bj*b, coords[s, 2] - bk*b
+                        for i in range(max(si - r, 0), min(si + r + 1, b)):
+                            di2 = (i - si)*(i - si)
+                            for j in range(max(sj - r, 0), min(sj + r + 1, b)):
+                                dij2 = di2 + (j - sj)*(j - sj)
+                                if dij2 > reach2:
+                                    continue
+                                for k in range(max(sk - r, 0), min(sk + r + 1, b)):
+                                    d2 = dij2 + (k - sk)*(k - sk)
+                                    if d2 < block[i, j, k]:
+                                        block[i, j, k] = d2
+        for i in range(b):
+            for j in range(b):
+                for k in range(b):
+                    if block[i, j, k] == 0:
+                        block[i, j, k] = -1.0
+                    else:
+                        block[i, j, k] = np.sqrt(block[i, j, k])
+
+def strutBand(struts, reach, band, brick=nb.BRICK):
+    #struts = strutFinder output, negative on strut voxels
+    #reach = distance (in voxels) past which values are clamped
+    #band = band of the returned field, at least reach
+    #Outputs strutDistance(struts, reach) as a NarrowBandField. Only bricks within
+    #reach of a strut voxel are allocated and stamped; every other brick is far
+    #at the clamped value, so no dense float32 grid is built for the result.
+    reach = float(max(reach, 1.0))
+    grid = tuple(-(-dim//brick) for dim in struts.shape)
+    coords = np.argwhere(np.asarray(struts) <= 0).astype(np.int64)
+    owner = np.ravel_multi_index(tuple((coords//brick).T), grid)
+    order = np.argsort(owner, kind="stable")
+    coords, owner = np.ascontiguousarray(coords[order]), owner[order]
+    offsets = np.searchsorted(owner, np.arange(int(np.prod(grid)) + 1)).astype(np.int64)
+    occupied = np.zeros(grid, dtype=bool)
+    occupied.flat[owner] = True
+    R = -(-int(np.ceil(reach))//brick)
+    near = ndimage.binary_dilation(occupied, np.ones((2*R + 1,)*3, dtype=bool)) if len(coords) else occupied
+    ids = np.flatnonzero(near).astype(np.int64)
+    blocks = np.empty((len(ids), brick, brick, brick), dtype=np.float32)
+    _strut_band_cpu(coords, offsets, ids, np.array(grid, dtype=np.int64), reach, blocks)
+    #Candidate bricks that ended up entirely at the clamp hold no band voxels.
+    clamp = np.sqrt(np.float32(reach*reach))
+    keep = (blocks < clamp).any(axis=(1, 2, 3))
+    index = np.full(int(np.prod(grid)), -1, dtype=np.int32)
+    index[ids[keep]] = np.arange(int(keep.sum()), dtype=np.int32)
+    far = np.full(grid, clamp, dtype=np.float32)
+    return nb.NarrowBandField(struts.shape, band, brick, index.reshape(grid), np.ascontiguousarray(blocks[keep]), far)
+
+def strutField(struts, strutRadius):
+    #Strut SDF handed to the trim: bricked straight from the strut voxels when
+    #NARROW_BAND_VOX is set, otherwise a dense grid taken from the pool.
+    reach = strutRadius + STRUT_MARGIN
+    if NARROW_BAND_VOX > 0:
+        return strutBand(struts, reach, max(NARROW_BAND_VOX, strutRadius + 2.0))
+    return strutDistance(struts, reach, out=pool.take(struts.shape))
+
+def strutDistance(struts,reach,out=None):
+    #struts = strutFinder output, negative on strut voxels
+    #reach = distance (in voxels) past which values are clamped, strut radius plus a margin
+    #out = optional float32 array for the result, must not be struts
+    #Outputs -1 on struts and the Euclidean distance to the nearest strut voxel
+    #elsewhere, clamped at reach. Matches SDF3D(struts) wherever thicken and the
+    #booleans can see it, without the inside transform or the far field.
+    reach = float(max(reach, 1.0))
+    if not useCuda("strutDistance", struts.size):
+        coords = np.argwhere(np.asarray(struts) <= 0).astype(np.int64)
+        offsets = np.searchsorted(coords[:, 0], np.arange(struts.shape[0] + 1)).astype(np.int64)
+        if out is None:
+            out = np.empty(struts.shape, dtype=np.float32)
+        _strut_distance_cpu(coords, offsets, reach, out)
+        return out
+    dims = struts.shape
+    d_struts = cuda.to_device(np.asarray(struts, dtype=np.float32))
+    d_out = cuda.device_array(dims, dtype=np.float32)
     gridSize = (
         (dims[0] + TPB - 1) // TPB,
         (dims[1] + TPB - 1) // TPB,
         (dims[2] + TPB - 1) // TPB,
     )
     blockSize = (TPB, TPB, TPB)
-    strutFinderKernel[gridSize, blockSize](d_points,d_struts)
-    return d_struts.copy_to_host()
+    strutDistanceKernel[gridSize, blockSize](d_struts,d_out,int(np.ceil(reach)),reach*reach)
+    if out is None:
+        return d_out.copy_to_host()
+    d_out.copy_to_host(out)
+    return out
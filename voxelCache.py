@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import userInput as u
+
+# Persistent cache of condensed model SDFs, keyed on the STL contents and the
+# settings that shape the grid. Each entry is a directory holding field.npy,
+# box.npy and meta.json; fields load as copy-on-write memory maps. Entries are
+# evicted least-recently-used first once the cache exceeds CACHE_MAX_MB.
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'Cache')
+CACHE_VERSION = 1
+
+def fileDigest(filepath, blockSize=1 << 20):
+    #Returns the sha256 hex digest of the file contents.
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as fp:
+        for block in iter(lambda: fp.read(blockSize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cacheKey(filepath, resolution, buffer, method, version):
+    #filepath = STL that is being voxelized
+    #resolution, buffer = voxelize arguments
+    #method, version = name and version of the code producing the field
+    #Outputs a hex key that changes whenever any input to the field changes.
+    params = json.dumps([CACHE_VERSION, fileDigest(filepath), int(resolution), int(buffer), method, version])
+    return hashlib.sha256(params.encode()).hexdigest()
+
+def loadCached(key, cacheDir=CACHE_DIR):
+    #Outputs (field, objectBox, gridShape) for a stored key, or None on a miss.
+    entry = os.path.join(cacheDir, key)
+    try:
+        with open(os.path.join(entry, 'meta.json')) as fp:
+            meta = json.load(fp)
+        field = np.load(os.path.join(entry, 'field.npy'), mmap_mode='c')
+        objectBox = np.load(os.path.join(entry, 'box.npy'))
+    except (OSError, ValueError):
+        return None
+    os.utime(os.path.join(entry, 'meta.json'))
+    return field, objectBox, tuple(meta['gridShape'])
+
+def storeCached(key, field, objectBox, gridShape, maxMB=None, cacheDir=CACHE_DIR):
+    #Writes an entry atomically, then trims the cache to maxMB (defaults to u.CACHE_MAX_MB).
+    os.makedirs(cacheDir, exist_ok=True)
+    entry = os.path.join(cacheDir, key)
+    staging = entry + '.tmp%d' % os.getpid()
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    np.save(os.path.join(staging, 'field.npy'), np.ascontiguousarray(field, dtype=np.float32))
+    np.save(os.path.join(staging, 'box.npy'), np.asarray(objectBox))
+    with open(os.path.join(staging, 'meta.json'), 'w') as fp:
+        json.dump({'gridShape': [int(dim) for dim in gridShape]}, fp)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(staging, entry)
+    if maxMB is None:
+        maxMB = getattr(u, "CACHE_MAX_MB", 2048)
+    evict(maxMB*1024*1024, cacheDir)
+
+def evict(maxBytes, cacheDir=CACHE_DIR):
+    #Deletes the least recently used entries until the cache fits in maxBytes.
+    entries = []
+    for name in os.listdir(cacheDir):
+        entry = os.path.join(cacheDir, name)
+        meta = os.path.join(entry, 'meta.json')
+        if not os.path.isfile(meta):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(meta), size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= maxBytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
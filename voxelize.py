@@ -1,36 +1,59 @@
-from numba import cuda
+from numba import cuda, njit, prange
 from numba.cuda.cudadrv.error import CudaSupportError
 import math
+import os
+import re
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from struct import unpack
-from operator import itemgetter
 import userInput as u
+from backend import useCuda
 try: TPB = u.TPB 
 except: TPB = 8
+VOXELIZER = getattr(u, "VOXELIZER", "scanline")
+VOXELIZE_WORKERS = getattr(u, "VOXELIZE_WORKERS", 0)
+LAYER_CHUNK = 8
+VOXELIZER_VERSION = 2 #Bump when voxelize output changes, invalidates voxelCache entries
 
 # From https://github.com/cpederkoff/stl-to-voxel
 
-def voxelize(inputFilePath, resolution,buffer):
-    mesh = list(read_stl_verticies(inputFilePath))
-    modelSize = np.zeros(3, dtype=np.float32)
-    pointList = list(map(list,sum(mesh,())))
-    for i in range(3):
-        pointList = sorted(pointList, key=itemgetter(i))
-        modelSize[2-i] = pointList[-1][i]-pointList[0][i]
-    (scale, shift, bounding_box) = calculateScaleAndShift(mesh, resolution)
-    mesh = list(scaleAndShiftMesh(mesh, scale, shift))
+def voxelize(inputFilePath, resolution,buffer,engine=None):
+    #engine = "scanline" (vectorized parity fill) or "legacy" (per-pixel loop), defaults to u.VOXELIZER
+    if engine is None:
+        engine = VOXELIZER
+    mesh, modelSize, bounding_box = loadScaledMesh(inputFilePath, resolution)
+    if engine == "legacy":
+        legacyMesh = [tuple(map(tuple, tri)) for tri in mesh]
+    else:
+        index = buildLayerIndex(mesh)
     vol = np.zeros((bounding_box[2],bounding_box[0],bounding_box[1]), dtype=bool)
-    for height in range(bounding_box[2]):
-        lines = toIntersectingLines(mesh, height)
-        prepixel = np.zeros((bounding_box[0], bounding_box[1]), dtype=bool)
-        linesToVoxels(lines, prepixel)
-        vol[height] = prepixel
-        if height%50<1:
-            print("On layer "+str(height)+" of "+str(bounding_box[2]))
+    workers = VOXELIZE_WORKERS if VOXELIZE_WORKERS > 0 else (os.cpu_count() or 1)
+    if engine != "legacy" and workers > 1:
+        voxelizeLayersParallel(index, vol, workers)
+    else:
+        for height in range(bounding_box[2]):
+            prepixel = np.zeros((bounding_box[0], bounding_box[1]), dtype=bool)
+            if engine == "legacy":
+                linesToVoxels(toIntersectingLines(legacyMesh, height), prepixel)
+            else:
+                linesToVoxelsFast(sliceLayer(index, height), prepixel)
+            vol[height] = prepixel
+            if height%50<1:
+                print("On layer "+str(height)+" of "+str(bounding_box[2]))
     vol = padVoxelArray(vol,buffer)
     print("Voxelize complete!")
     return toFRep(vol), modelSize
 
+def loadScaledMesh(inputFilePath, resolution):
+    #Reads an STL and scales it onto the voxel grid.
+    #Returns the scaled (N,3,3) triangles, the model size (Z,Y,X order, file units) and the grid bounding box.
+    mesh = loadSTL(inputFilePath)
+    points = mesh.reshape(-1, 3)
+    modelSize = (points.max(axis=0) - points.min(axis=0))[::-1].astype(np.float32)
+    (scale, shift, bounding_box) = calculateScaleAndShift(mesh, resolution)
+    mesh = scaleAndShiftMesh(mesh, scale, shift)
+    return mesh, modelSize, bounding_box
+
 def linesToVoxels(lineList, pixels):
     for x in range(len(pixels)):
         isBlack = False
@@ -47,6 +70,79 @@ def linesToVoxels(lineList, pixels):
         if isBlack:
             print("an error has occured at x%sz%s"%(x,lineList[0][0][2]))
 
+@njit(parallel=True)
+def _scanline_fill(segments, pixels):
+    #segments = (S,2,2) array of layer segment endpoints in (x,y)
+    #Fills every x row of pixels between pairs of sorted y crossings, matching
+    #the parity rules of linesToVoxels. Returns the number of rows left open.
+    nx, ny = pixels.shape
+    s = segments.shape[0]
+    errors = np.zeros(nx, dtype=np.int64)
+    for x in prange(nx):
+        crossings = np.empty(s, dtype=np.int64)
+        count = 0
+        for l in range(s):
+            x0 = segments[l, 0, 0]
+            y0 = segments[l, 0, 1]
+            x1 = segments[l, 1, 0]
+            y1 = segments[l, 1, 1]
+            above = x0 > x or x1 > x
+            below = x0 < x or x1 < x
+            same = x0 == x or x1 == x
+            if not ((above and below) or (same and above)):
+                continue
+            if x1 == x0:
+                continue
+            y = int(y0 + (x - x0) / (x1 - x0) * (y1 - y0))
+            if y < 0 or y >= ny:
+                continue
+            crossings[count] = y
+            count += 1
+        crossings = np.sort(crossings[:count])
+        for c in range(0, count - 1, 2):
+            for y in range(crossings[c], crossings[c+1] + 1):
+                pixels[x, y] = True
+        if count % 2 == 1:
+            for y in range(crossings[count-1], ny):
+                pixels[x, y] = True
+            errors[x] = 1
+    return errors.sum()
+
+def linesToVoxelsFast(lineList, pixels):
+    #lineList = layer segments, either a list of point pairs or a (S,2,3) array from sliceLayer
+    #Drop-in replacement for linesToVoxels that fills all rows of a layer in one compiled pass.
+    segments = np.asarray(lineList, dtype=np.float64).reshape(-1, 2, 3)
+    if _scanline_fill(np.ascontiguousarray(segments[:, :, :2]), pixels) > 0:
+        print("an error has occured at z%s"%(segments[0, 0, 2]))
+
+_scanline_fill_serial = njit(nogil=True)(_scanline_fill.py_func)
+
+def _voxelize_layers(index, vol, start, stop):
+    errors = []
+    for height in range(start, stop):
+        segments = sliceLayer(index, height)
+        if _scanline_fill_serial(np.ascontiguousarray(segments[:, :, :2]), vol[height]) > 0:
+            errors.append(height)
+    return stop - start, errors
+
+def voxelizeLayersParallel(index, vol, workers):
+    #index = output of buildLayerIndex
+    #vol = preallocated (layers, X, Y) boolean volume, filled in place
+    #workers = number of threads; each takes chunks of LAYER_CHUNK layers and
+    #writes straight into its slice of vol, the fill itself runs without the GIL.
+    layers = vol.shape[0]
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_voxelize_layers, index, vol, start, min(start+LAYER_CHUNK, layers))
+                   for start in range(0, layers, LAYER_CHUNK)]
+        for future in as_completed(futures):
+            count, errors = future.result()
+            for height in errors:
+                print("an error has occured at z%s"%(height))
+            if (done+count)//50 > done//50 or done == 0:
+                print("On layer "+str(done)+" of "+str(layers))
+            done += count
+
 def findRelevantLines(lineList, x, ind=0):
     for line in lineList:
         same = False
@@ -83,69 +179,72 @@ def onLine(line, x, y):
         return False
     return True
 
+STL_RECORD = np.dtype([
+    ('normals', '<f4', (3,)),
+    ('vertices', '<f4', (3,3)),
+    ('attr', '<u2'),
+])
+
 def BinarySTL(fname):
-    fp = open(fname, 'rb')
-    Header = fp.read(80)
-    nn = fp.read(4)
-    Numtri = unpack('i', nn)[0]
-    record_dtype = np.dtype([
-        ('normals', np.float32, (3,)),
-        ('Vertex1', np.float32, (3,)),
-        ('Vertex2', np.float32, (3,)),
-        ('Vertex3', np.float32, (3,)),
-        ('atttr', '<i2', (1,) )
-    ])
-    data = np.fromfile(fp, dtype=record_dtype, count=Numtri)
-    fp.close()
-
-    Normals = data['normals']
-    Vertex1 = data['Vertex1']
-    Vertex2 = data['Vertex2']
-    Vertex3 = data['Vertex3']
-
-    p = np.append(Vertex1, Vertex2, axis=0)
-    p = np.append(p, Vertex3, axis=0)  #list(v1)
-    Points = np.array(list(set(tuple(p1) for p1 in p)))
-    return Header, Points, Normals, Vertex1, Vertex2, Vertex3
+    #Memory-maps a binary STL and returns its triangles as an (N,3,3) float32 view, no copies.
+    with open(fname, 'rb') as fp:
+        fp.seek(80)
+        Numtri = unpack('<I', fp.read(4))[0]
+    if Numtri == 0:
+        return np.zeros((0,3,3), dtype=np.float32)
+    data = np.memmap(fname, dtype=STL_RECORD, mode='r', offset=84, shape=(Numtri,))
+    return data['vertices']
+
+ASCII_VERTEX = re.compile(rb'vertex[ \t]+([^\r\n]+)')
+ASCII_CHUNK = 1 << 24
 
 def AsciiSTL(fname):
-    with open(fname, 'r') as input_data:
-        # Skips text before the beginning of the interesting block:
-        init = False
-        triangles = []
-        verticies = []
-        for line in input_data:
-            if line.strip() == 'outer loop':  # Or whatever test is needed
-                init = True
-                verticies = []
-                continue
-            # Reads text until the end of the block:
-            elif line.strip() == 'endloop':
-                init = False
-                triangles.append(verticies)
-                continue
-            elif init:
-                words = line.strip().split()
-                assert words[0] == 'vertex'
-                verticies.append((float(words[1]), float(words[2]), float(words[3])))
-    return triangles
+    #Parses an ASCII STL in large byte blocks: the coordinates of every vertex
+    #line in a block are pulled out with one regex pass and converted in bulk.
+    #Returns the triangles as an (N,3,3) float32 array.
+    blocks = []
+    tail = b''
+    with open(fname, 'rb') as input_data:
+        while True:
+            chunk = input_data.read(ASCII_CHUNK)
+            if not chunk:
+                break
+            chunk = tail + chunk
+            cut = chunk.rfind(b'\n') + 1
+            tail = chunk[cut:]
+            fields = ASCII_VERTEX.findall(chunk, 0, cut)
+            if fields:
+                blocks.append(np.fromstring(b' '.join(fields), dtype=np.float32, sep=' '))
+    if tail:
+        fields = ASCII_VERTEX.findall(tail)
+        if fields:
+            blocks.append(np.fromstring(b' '.join(fields), dtype=np.float32, sep=' '))
+    if not blocks:
+        return np.zeros((0,3,3), dtype=np.float32)
+    values = np.concatenate(blocks)
+    assert values.size % 9 == 0, "Malformed ASCII STL: vertex count is not a multiple of 3"
+    return values.reshape(-1,3,3)
 
 def IsAsciiStl(fname):
+    #Binary STLs are exactly 84 bytes plus 50 per triangle; anything else that
+    #starts with "solid" and holds facet records is treated as ASCII. This catches
+    #binary exporters that also write "solid" into their header.
+    size = os.path.getsize(fname)
     with open(fname,'rb') as input_data:
-        line = input_data.readline()
-        if line[:5] == b'solid':
-            return True
-        else:
-            return False
+        head = input_data.read(1024)
+    if size >= 84 and 84 + 50*unpack('<I', head[80:84])[0] == size:
+        return False
+    return head[:5] == b'solid' and (b'facet' in head or b'endsolid' in head)
 
-def read_stl_verticies(fname):
+def loadSTL(fname):
+    #Returns the triangles of an ASCII or binary STL as an (N,3,3) float32 array.
     if IsAsciiStl(fname):
-        for (i,j,k) in AsciiSTL(fname):
-            yield (tuple(i),tuple(j),tuple(k))
-    else:
-        head, p, n, v1, v2, v3 = BinarySTL(fname)
-        for i, j, k in zip(v1, v2, v3):
-            yield (tuple(i), tuple(j), tuple(k))
+        return AsciiSTL(fname)
+    return BinarySTL(fname)
+
+def read_stl_verticies(fname):
+    for (i,j,k) in loadSTL(fname):
+        yield (tuple(i),tuple(j),tuple(k))
 """
 @cuda.jit
 def padVoxelArrayKernel(d_u,d_v,padding):
@@ -174,11 +273,8 @@ def padVoxelArray(voxels,padding):
 def padVoxelArray(voxels,padding):
     shape = voxels.shape
     new_shape = (shape[0]+2*padding,shape[1]+2*padding,shape[2]+2*padding)
-    vol = np.zeros(new_shape, dtype=float)
-    for a in range(shape[0]):
-        for b in range(shape[1]):
-            for c in range(shape[2]):
-                vol[a+padding,b+padding,c+padding] = voxels[a,b,c]
+    vol = np.zeros(new_shape, dtype=voxels.dtype)
+    vol[padding:padding+shape[0],padding:padding+shape[1],padding:padding+shape[2]] = voxels
     return vol
 
 def toIntersectingLines(mesh, height):
@@ -187,6 +283,50 @@ def toIntersectingLines(mesh, height):
     lines = list(map(lambda tri: triangleToIntersectingLines(tri, height), notSameTriangles))
     return lines
 
+def buildLayerIndex(mesh):
+    #mesh = scaled triangles, list of point triples or an (N,3,3) array
+    #Returns the triangles sorted by their lowest z plus the sorted min-z, the
+    #matching max-z and the tallest triangle span, so sliceLayer can find the
+    #triangles touching a layer with two binary searches.
+    tris = np.asarray(mesh).reshape(-1, 3, 3)
+    zmins = tris[:, :, 2].min(axis=1)
+    order = np.argsort(zmins, kind="stable")
+    tris = tris[order]
+    zmins = zmins[order]
+    zmaxs = tris[:, :, 2].max(axis=1)
+    span = float(np.max(zmaxs - zmins)) if len(tris) else 0.0
+    return tris, zmins, zmaxs, span
+
+def sliceLayer(index, height):
+    #index = output of buildLayerIndex
+    #Vectorized toIntersectingLines: returns a (S,2,3) array with one segment
+    #per triangle crossing the plane z = height.
+    tris, zmins, zmaxs, span = index
+    lo = np.searchsorted(zmins, height - span, side="left")
+    hi = np.searchsorted(zmins, height, side="right")
+    tris = tris[lo:hi][zmaxs[lo:hi] >= height]
+    z = tris[:, :, 2]
+    above = z > height
+    below = z < height
+    same = z == height
+    relevant = (same.sum(axis=1) == 2) | (above.any(axis=1) & below.any(axis=1))
+    tris, above, below, same = tris[relevant], above[relevant], below[relevant], same[relevant]
+    # Segment endpoints are the vertices lying on the plane plus the points
+    # where the plane crosses edges running from below to above it.
+    p1 = tris
+    p2 = np.roll(tris, -1, axis=1)
+    crosses = (above & np.roll(below, -1, axis=1)) | (below & np.roll(above, -1, axis=1))
+    swap = (p1[:, :, 2] > p2[:, :, 2])[:, :, None]
+    low = np.where(swap, p2, p1)
+    high = np.where(swap, p1, p2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distance = (height - low[:, :, 2:]) / (high[:, :, 2:] - low[:, :, 2:])
+        crossing = low - distance * (low - high)
+    points = np.concatenate((tris, crossing), axis=1)
+    flags = np.concatenate((same, crosses), axis=1)
+    first = np.argsort(~flags, axis=1, kind="stable")[:, :2]
+    return np.take_along_axis(points, first[:, :, None], axis=1)
+
 def drawLineOnPixels(p1, p2, pixels):
     lineSteps = math.ceil(manhattanDistance(p1, p2))
     if lineSteps == 0:
@@ -266,30 +406,21 @@ def whereLineCrossesZ(p1, p2, z):
     return linearInterpolation(p1, p2, distance)
 
 def calculateScaleAndShift(mesh, resolution):
-    allPoints = [item for sublist in mesh for item in sublist]
-    mins = [0, 0, 0]
-    maxs = [0, 0, 0]
-    for i in range(3):
-        mins[i] = min(allPoints, key=lambda tri: tri[i])[i]
-        maxs[i] = max(allPoints, key=lambda tri: tri[i])[i]
-    shift = [-min for min in mins]
+    points = np.asarray(mesh).reshape(-1, 3)
+    mins = points.min(axis=0)
+    maxs = points.max(axis=0)
+    shift = -mins
     xyscale = float(resolution - 1) / (max(maxs[0] - mins[0], maxs[1] - mins[1]))
     scale = [xyscale, xyscale, xyscale]
     bounding_box = [resolution, resolution, math.ceil((maxs[2] - mins[2]) * xyscale)]
     return (scale, shift, bounding_box)
 
 def scaleAndShiftMesh(mesh, scale, shift):
-    for tri in mesh:
-        newTri = []
-        for pt in tri:
-            newpt = [0, 0, 0]
-            for i in range(3):
-                newpt[i] = (pt[i] + shift[i]) * scale[i]
-            newTri.append(tuple(newpt))
-        if len(removeDupsFromPointList(newTri)) == 3:
-            yield newTri
-        else:
-            pass
+    #Returns the scaled (N,3,3) triangles, dropping those that collapse to a line or point.
+    tris = (np.asarray(mesh) + shift) * np.asarray(scale, dtype=np.float32)
+    v0, v1, v2 = tris[:, 0], tris[:, 1], tris[:, 2]
+    degenerate = (v0 == v1).all(axis=1) | (v1 == v2).all(axis=1) | (v0 == v2).all(axis=1)
+    return tris[~degenerate]
 
 def manhattanDistance(p1, p2, d=2):
     assert (len(p1) == len(p2))
@@ -302,10 +433,6 @@ def removeDupsFromPointList(ptList):
     newList = ptList[:]
     return tuple(set(newList))
 
-try:
-    CUDA_AVAILABLE = cuda.is_available()
-except Exception:
-    CUDA_AVAILABLE = False
 
 @cuda.jit
 def toFRepKernel(d_u,d_v):
@@ -320,12 +447,12 @@ def toFRepKernel(d_u,d_v):
 
 def _to_frep_cpu(u):
     mask = u > 0.5
-    positive = np.where(mask, -0.01, 0.01).astype(np.float32)
+    positive = np.where(mask, np.float32(-0.01), np.float32(0.01))
     return positive
 
 def toFRep(u):
     dims = u.shape
-    if CUDA_AVAILABLE:
+    if useCuda("toFRep", u.size):
         try:
             d_u = cuda.to_device(u)
             d_v = cuda.device_array(dims,dtype=np.float32)